@@ -27,6 +27,9 @@
 #       e.g. raise OSError("no files to open")
 
 # general imports
+import copy
+import gc
+import hmac
 import logging
 import matplotlib.pyplot as plt
 import matplotlib.style as mplstyle
@@ -39,7 +42,8 @@ import time
 
 # o3as related imports
 import o3api.config as cfg
-# import o3api.debug as dbg
+import o3api.datastore as o3store
+import o3api.debug as dbg
 import o3api.load as o3load
 import o3api.plothelpers as phlp
 import o3api.prepare as o3prepare
@@ -50,7 +54,6 @@ from flask import jsonify, make_response, request, send_file
 from fpdf import FPDF, HTMLMixin
 from functools import partial, wraps
 from io import BytesIO
-from multiprocessing import Pool
 from PyPDF3 import PdfFileMerger
 
 # mplstyle
@@ -88,13 +91,44 @@ VMRO3 = cfg.netCDF_conf['vmro3']
 plot_c = cfg.plot_conf
 PLOT_ST = cfg.plot_conf['plot_st']
 
-# dictionary to load O3as data in memory
-o3data = {
-    'tco3_zm': o3load.LoadData(cfg.O3AS_DATA_BASEPATH,
-                               "tco3_zm").load_dataset_ensemble(),
-    'vmro3_zm': o3load.LoadData(cfg.O3AS_DATA_BASEPATH,
-                                "vmro3_zm").load_dataset_ensemble()
-    }
+
+# catalogue of available models, see __get_models_catalogue()
+_models_catalogue = None
+
+
+def _prepare_data(ptype, ds_ensemble):
+    """Precompute results for default requests, after data is (re)loaded
+    """
+    if ptype == TCO3 and cfg.O3AS_TCO3Return_PRECOMPUTE:
+        tco3zm.precompute_default_regions(ds_ensemble)
+
+
+# load O3as data in memory, as {'plot type': {'model': dataset}}
+# plot types not in O3AS_DATA_PRELOAD are loaded when first requested
+o3data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [TCO3, VMRO3],
+                           preload=cfg.O3AS_DATA_PRELOAD,
+                           prepare=_prepare_data)
+# load data at start, in the background the API answers while loading
+# (see /health, /ready)
+o3data.start(background=cfg.O3AS_DATA_LOAD_BACKGROUND)
+o3data.start_polling(cfg.O3AS_DATA_RELOAD_INTERVAL)
+
+
+def prepare_for_fork():
+    """Prepare preloaded data to be shared copy-on-write by the workers,
+    forked by gunicorn (see gunicorn.conf.py, O3API_PRELOAD):
+    dataset files are closed, so workers do not share file handles
+    (they re-open files if needed), and all Python objects are moved to the
+    permanent GC generation, so the garbage collector in workers does not
+    touch them. Reference count updates still copy the pages of objects
+    used by a worker, data values in numpy buffers stay shared.
+    """
+    for ds_ensemble in o3data.values():
+        for ds in ds_ensemble.values():
+            ds.close()
+
+    gc.collect()
+    gc.freeze()
 
 
 def _catch_error(f):
@@ -126,6 +160,26 @@ def _catch_error(f):
     return wrap
 
 
+def _require_data(f):
+    """Decorate function to return 503 (Service Unavailable)
+       with the Retry-After header, until data is loaded
+    """
+
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if not o3data.is_ready():
+            e_message = [{'status': 'Error',
+                          'source': f.__name__,
+                          'message': 'Data is not loaded yet, retry later'}]
+            response = make_response(jsonify(e_message), 503)
+            response.headers['Retry-After'] = cfg.O3AS_DATA_RETRY_AFTER
+            return response
+
+        return f(*args, **kwargs)
+
+    return wrap
+
+
 def __convert_plot_style(models_style, ptype):
     """Function to convert array of dictionaries with model:name to 
        dictionary with named by model elements
@@ -245,24 +299,107 @@ def get_api_info():
     return meta
 
 
+@_catch_error
+def get_health():
+    """Return liveness of the API: the API process is running.
+    Returns 500, if data loading at start failed.
+
+    :return: status, size and queue depth of the processing thread pool
+    :rtype: dict
+    """
+    status = o3data.get_status()
+    if status['error'] is not None:
+        return make_response(jsonify({'status': 'error',
+                                      'error': status['error']}), 500)
+
+    return dict({'status': 'ok'}, **o3prepare.get_executor_status())
+
+
+@_catch_error
+def get_ready():
+    """Return readiness of the API and data loading progress.
+    Returns 503 with the Retry-After header, until data is loaded.
+
+    :return: ready, loaded plot types, models and bytes loaded, elapsed time
+    :rtype: dict
+    """
+    status = o3data.get_status()
+    if not status['ready']:
+        response = make_response(jsonify(status), 503)
+        response.headers['Retry-After'] = cfg.O3AS_DATA_RETRY_AFTER
+        return response
+
+    return status
+
+
+def _not_authorized(source):
+    """Check the admin token (X-Admin-Token) of the request
+
+    :param source: Name of the endpoint function, for the error message
+    :return: 403 response if the token is not valid, None otherwise
+    """
+    token = request.headers.get('X-Admin-Token', '')
+    if (not cfg.O3AS_ADMIN_TOKEN or
+        not hmac.compare_digest(token, cfg.O3AS_ADMIN_TOKEN)):
+        e_message = [{'status': 'Error',
+                      'source': source,
+                      'message': 'Not authorized'}]
+        return make_response(jsonify(e_message), 403)
+
+    return None
+
+
+@_catch_error
+def reload_data(*args, **kwargs):
+    """Reload data: only new or changed datafiles are loaded, then
+    the updated data is swapped in. Requires the admin token (X-Admin-Token).
+
+    :return: summary of changes and the data generation
+    :rtype: dict
+    """
+    response = _not_authorized('reload_data')
+    if response is not None:
+        return response
+
+    return o3data.reload()
+
+
+@_catch_error
+def get_memory_info(*args, **kwargs):
+    """Return resident memory of the worker serving the request.
+    Requires the admin token (X-Admin-Token).
+
+    :return: pid and memory in bytes (rss, pss, shared, private),
+             bytes held by datasets and the ensemble cube
+             as {'plot type': {'model': bytes}}
+    :rtype: dict
+    """
+    response = _not_authorized('get_memory_info')
+    if response is not None:
+        return response
+
+    memory = {'pid': os.getpid()}
+    memory.update(dbg.get_memory_usage())
+    # bytes held by datasets and cube of loaded plot types, per model
+    memory['data'] = { ptype: dict(getattr(ds_ensemble, 'nbytes', {}))
+                       for ptype, ds_ensemble in o3data.items() }
+
+    return memory
+
+
 @_catch_error
 def get_data_types():
     """Get list of plot types with available data"""
 
-    ptypes = []
     possible_types = [TCO3, TCO3Return, VMRO3]
-
-    kwargs = {}
-    for t in possible_types:
-        kwargs[PTYPE] = t
-        models = get_models_list(**kwargs)
-        isdata = True if len(models) > 0 else False
-        ptypes.append(t) if isdata else ''
+    models_types = __get_models_catalogue()['types']
+    ptypes = [ t for t in possible_types if len(models_types[t]) > 0 ]
 
     return ptypes
 
 
 @_catch_error
+@_require_data
 def get_data_tco3_zm(*args, **kwargs):
     """Retrieve data to produce tco3_zm plot
 
@@ -290,6 +427,7 @@ def get_data_tco3_zm(*args, **kwargs):
 
 
 @_catch_error
+@_require_data
 def get_data_tco3_return(*args, **kwargs):
     """Retrieve data to produce tco3_return plot
 
@@ -328,6 +466,37 @@ def get_data_vmro3_zm(*args, **kwargs):
     pass
 
 
+def __get_models_catalogue():
+    """Return the catalogue of available models, built by scanning
+    the data directory once: rebuilt only if the directory (its
+    modification time) or the data generation (reload) changes.
+    The catalogue is shared, i.e. should not be modified.
+
+    :return: {'models': list of models with the meta info,
+              'index': {model: meta info},
+              'types': {plot type: sorted models with data}}
+    :rtype: dict
+    """
+    global _models_catalogue
+    key = (cfg.O3AS_DATA_BASEPATH,
+           os.stat(cfg.O3AS_DATA_BASEPATH).st_mtime_ns,
+           o3data.generation)
+    catalogue = _models_catalogue
+    if catalogue is None or catalogue['key'] != key:
+        models = __scan_models_info()
+        catalogue = {'key': key,
+                     'models': models,
+                     'index': { m['model']: m for m in models },
+                     'types': { pt: sorted(m['model'] for m in models
+                                           if m[pt]['isdata'])
+                                for pt in [TCO3, TCO3Return, VMRO3] }}
+        # single reference assignment, requests in progress keep the old one
+        _models_catalogue = catalogue
+        logger.debug(F"[CATALOGUE] {len(models)} models")
+
+    return catalogue
+
+
 @_catch_error
 def get_models_info():
     """Return dictionary of available models with the meta info
@@ -335,6 +504,15 @@ def get_models_info():
     :return: The dictionary of available models
     :rtype: dict
     """
+    return copy.deepcopy(__get_models_catalogue()['models'])
+
+
+def __scan_models_info():
+    """Scan the data directory for available models with the meta info
+
+    :return: The list of available models
+    :rtype: list
+    """
     models = []
     plot_types = get_plot_types()
 
@@ -435,16 +613,11 @@ def get_models_list(*args, **kwargs):
     :return: The list of available models
     :rtype: list
     """
-    models_list = []
-
-    models_info = get_models_info()
+    catalogue = __get_models_catalogue()
     if PTYPE in kwargs:
-        ptype = kwargs[PTYPE]
-        for m in models_info:
-            if m[ptype]['isdata']:
-                models_list.append(m['model'])
+        models_list = list(catalogue['types'][kwargs[PTYPE]])
     else:
-        models_list = [ m['model'] for m in models_info ]
+        models_list = [ m['model'] for m in catalogue['models'] ]
 
     if 'select' in kwargs:
         pattern = kwargs['select'].lower()
@@ -458,7 +631,7 @@ def get_models_list(*args, **kwargs):
 def get_plot_style(*args, **kwargs):
     """Returning plot style for selected models and plot type
     """
-    models_info = get_models_info()
+    models_info = __get_models_catalogue()['models']
     plots_format = []
 
     if MODELS in kwargs:
@@ -481,13 +654,14 @@ def get_plot_style(*args, **kwargs):
             pfmt['model'] = m['model']
             for pt in plot_types:
                 pfmt[pt] = {}
-                pfmt[pt][PLOT_ST] = m[pt][PLOT_ST]
+                pfmt[pt][PLOT_ST] = dict(m[pt][PLOT_ST])
             plots_format.append(pfmt)
 
     return plots_format
 
 
 @_catch_error
+@_require_data
 def get_model_detail(*args, **kwargs):
     """Return information about the Ozone model
 
@@ -495,19 +669,28 @@ def get_model_detail(*args, **kwargs):
     :rtype: dict
     """
     model = kwargs['model'].lstrip().rstrip()
-    models_info = get_models_info()
-    model_info_dict = {}
-    for m in models_info:
-        if m['model'] == model:
-            model_info_dict = m
+    model_info_dict = copy.deepcopy(
+        __get_models_catalogue()['index'].get(model, {}))
 
     plot_types = get_data_types()
     for pt in plot_types:
         if model_info_dict[pt]['isdata']:
             kwargs[PTYPE] = pt
             # retrieve dataset according to the plot type (tco3_zm, vmro3_zm, etc)
-            ds = o3data[pt][model] if pt is not TCO3Return else o3data[TCO3][model]
-            model_info_dict[pt]['original_metadata'] = ds.to_dict(data=False)
+            pt_data = pt if pt is not TCO3Return else TCO3
+            if not o3data.is_loaded(pt_data):
+                # do not load the plot type only for metadata
+                model_info_dict[pt]['original_metadata'] = (
+                    o3load.LoadData(o3data.data_basepath,
+                                    pt_data).load_metadata(model) or
+                    {'attrs': {}})
+            elif model in o3data[pt_data].metadata:
+                # compact mode: metadata extracted before compacting
+                model_info_dict[pt]['original_metadata'] = copy.deepcopy(
+                    o3data[pt_data].metadata[model])
+            else:
+                model_info_dict[pt]['original_metadata'] = (
+                    o3data[pt_data][model].to_dict(data=False))
             #logger.debug("model_info:", model_info_dict[pt]['original_metadata'])
             model_info_dict[pt]['original_metadata']['attrs']  = (
             __dict_remove_elems(model_info_dict[pt]['original_metadata']['attrs']))
@@ -524,6 +707,7 @@ def get_plot_types():
 
 
 @_catch_error
+@_require_data
 def plot_tco3_zm(*args, **kwargs):
     """Plot tco3_zm
 
@@ -571,6 +755,14 @@ def plot_tco3_zm(*args, **kwargs):
                                   }
                           },
                         ]
+    # requested percentiles over models, see ProcessForTCO3Zm.get_ensemble_stats
+    for q in kwargs.get('percentiles', []):
+        models_stats_style.append({ 'model': F"MMP{q:g}",
+                                    TCO3: { PLOT_ST: {'color': 'blue',
+                                                      'linestyle': 'dashed',
+                                                      'linewidth': 1 }
+                                          }
+                                  })
 
     models_style.extend(models_stats_style)
 
@@ -603,13 +795,14 @@ def __fill_default_region(region, **kwargs):
     region_params = cfg.tco3_return_regions[region]
     kwargs.update(region_params)
     data = tco3zm.ProcessForTCO3ZmReturn(o3data['tco3_zm'], **kwargs)
-    data_return = data.get_ensemble_for_plot(kwargs[MODELS])
+    data_tco3 = data.get_ensemble_return(kwargs[MODELS])
     logger.debug(F"{region} processed")
 
-    return data_return
+    return data, data_tco3
 
 
 @_catch_error
+@_require_data
 def plot_tco3_return(*args, **kwargs):
     """Plot tco3_return
 
@@ -626,8 +819,6 @@ def plot_tco3_return(*args, **kwargs):
     user_lat_min = kwargs[LAT_MIN]
     user_lat_max = kwargs[LAT_MAX]
 
-    # initialize an empty pd.DataFrame
-    plot_data = pd.DataFrame()
     # First draw pre-defined regions
     #for r,p in cfg.tco3_return_regions.items():
     #    kwargs['region'] = r
@@ -641,17 +832,13 @@ def plot_tco3_return(*args, **kwargs):
     #    plot_data = plot_data.append(data_return)
 
     
-    plot_data_list = []
     default_regions = list(cfg.tco3_return_regions.keys())
 
-    # Process default regions in parallel
-    # Pool.map results are ordered (according to the input)!
-    with Pool() as pool:
-        plot_data_list = pool.map(partial(__fill_default_region, **kwargs),
-                                      default_regions)
-
-    for plot_region in plot_data_list:
-        plot_data = plot_data.append(plot_region)
+    # Process default regions in parallel, in the shared thread pool
+    # (results are ordered according to the input)
+    regions_list = o3prepare.map_tasks(partial(__fill_default_region,
+                                               **kwargs),
+                                       default_regions)
 
     # Then draw the user-defined region
     kwargs['region'] = 'User region'
@@ -660,7 +847,11 @@ def plot_tco3_return(*args, **kwargs):
     kwargs[LAT_MAX] = user_lat_max
     #('User region (' + str(kwargs['lat_min']) + ', ' + str(kwargs['lat_max']) + ')')
     data = tco3zm.ProcessForTCO3ZmReturn(o3data['tco3_zm'], **kwargs)
-    plot_data = plot_data.append(data.get_ensemble_for_plot(kwargs[MODELS]))
+    regions_list.append((data, data.get_ensemble_return(kwargs[MODELS])))
+
+    # return years of all regions are found at once
+    pdata_regions, data_regions = zip(*regions_list)
+    plot_data = tco3zm.get_regions_return_years(pdata_regions, data_regions)
 
     # define plot styling for the mean
     models_style = get_plot_style(**kwargs)
@@ -723,6 +914,7 @@ def plot_tco3_return(*args, **kwargs):
 
 
 @_catch_error
+@_require_data
 def plot_vmro3_zm(*args, **kwargs):
     """Plot vmro3_zm
 
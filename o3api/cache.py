@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 - 2022 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+
+"""
+Module with the DataCache class, on-disk cache of decoded datasets
+"""
+
+import hashlib
+import logging
+import o3api.config as cfg
+import os
+import pickle  # nosec B403, the cache is written and read only by o3api
+import tempfile
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+
+class DataCache:
+    """Class to store datasets, already decoded and converted to
+    the standard calendar, in the cache directory.
+    Every datafile has its own entry in the directory, the entry is valid
+    only if the datafile path, size and modification time did not change.
+
+    :param cache_dir: Directory to store cache entries
+    """
+
+    def __init__(self, cache_dir):
+        """Constructor method
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_signature(datafile_path):
+        """Return the signature of the datafile
+
+        :param datafile_path: Full path to the datafile
+        :return: (absolute path, size, modification time in ns)
+        :rtype: tuple
+        """
+        file_stat = os.stat(datafile_path)
+        return (os.path.abspath(datafile_path),
+                file_stat.st_size,
+                file_stat.st_mtime_ns)
+
+    def __entry_path(self, datafile_path):
+        """Return the path of the cache entry for the datafile
+        """
+        path_hash = hashlib.sha1(
+            os.path.abspath(datafile_path).encode('utf-8')).hexdigest()  # nosec B303
+        return os.path.join(self.cache_dir, path_hash + '.pkl')
+
+    def get(self, datafile_path):
+        """Read the dataset from the cache
+
+        :param datafile_path: Full path to the datafile
+        :return: xarray Dataset or None, if there is no valid entry
+        """
+        entry_path = self.__entry_path(datafile_path)
+        if not os.path.exists(entry_path):
+            return None
+
+        try:
+            with open(entry_path, 'rb') as f:
+                # signature is stored first, avoid reading stale data
+                signature = pickle.load(f)  # nosec B301
+                if signature != self.get_signature(datafile_path):
+                    logger.info(F"[CACHE] {datafile_path}: stale entry, rebuilding")
+                    return None
+                ds = pickle.load(f)  # nosec B301
+        except Exception as e:
+            logger.warning(F"[CACHE] {datafile_path}: failed to read entry ({e})")
+            return None
+
+        logger.debug(F"[CACHE] {datafile_path}: read from {entry_path}")
+        return ds
+
+    def put(self, datafile_path, ds):
+        """Store the dataset in the cache. The entry is written in a temporary
+        file and then renamed, i.e. concurrent readers never see partial entries.
+
+        :param datafile_path: Full path to the datafile
+        :param ds: xarray Dataset, loaded in memory
+        """
+        entry_path = self.__entry_path(datafile_path)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self.get_signature(datafile_path), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(ds, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, entry_path)
+        except Exception as e:
+            logger.warning(F"[CACHE] {datafile_path}: failed to write entry ({e})")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        logger.debug(F"[CACHE] {datafile_path}: stored in {entry_path}")
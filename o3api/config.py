@@ -43,6 +43,73 @@ O3AS_MODELNAME_SPLIT='_'
 
 O3AS_OBSERVED_PATTERN = os.getenv('O3AS_OBSERVED_PATTERN', 'observed')
 
+# Number of parallel workers to load datasets in memory (1: one by one)
+# and the kind of workers used for that ('thread' or 'process').
+# netCDF reading is serialized between threads, 'process' workers read
+# datafiles in parallel, but are forked from the API process (with its
+# threads and data), i.e. use them only if loading time matters
+O3AS_LOAD_WORKERS = int(os.getenv('O3AS_LOAD_WORKERS', os.cpu_count() or 1))
+O3AS_LOAD_EXECUTOR = os.getenv('O3AS_LOAD_EXECUTOR', 'thread').lower()
+
+# Number of threads (shared by all requests) to process models
+# of a request concurrently (1: one model after another)
+O3AS_PROCESS_WORKERS = int(os.getenv('O3AS_PROCESS_WORKERS',
+                                     min(4, os.cpu_count() or 1)))
+
+# Directory to cache decoded datasets (empty: no cache)
+O3AS_DATA_CACHE_DIR = os.getenv('O3AS_DATA_CACHE_DIR', '')
+
+# Build aligned models x months x lat array (ensemble cube) at load time,
+# requests then avoid selecting data model by model (opt-in).
+# The cube is kept in addition to the datasets: per value 8 bytes (4 in the
+# compact mode) plus 12 bytes of cumulative sums and counts along latitude,
+# i.e. about 3.5x the memory of the datasets alone. With O3AS_DATA_MMAP_DIR
+# the cube is shared by all workers and datasets are not loaded in memory.
+O3AS_ENSEMBLE_CUBE = os.getenv('O3AS_ENSEMBLE_CUBE', 'False').lower() in ['true', '1', 'yes']
+
+# Directory to store the ensemble cube as memory-mapped files, shared by
+# all workers through the OS page cache (empty: every worker keeps own copy).
+# Setting it builds the cube (whatever O3AS_ENSEMBLE_CUBE is), values are
+# not loaded in datasets then, unless the cube cannot be built (e.g. vmro3_zm)
+O3AS_DATA_MMAP_DIR = os.getenv('O3AS_DATA_MMAP_DIR', '')
+
+# Compact mode: keep only tco3_zm / vmro3_zm as float32 in memory,
+# other variables and attributes are dropped after metadata is extracted
+O3AS_DATA_COMPACT = os.getenv('O3AS_DATA_COMPACT', 'False').lower() in ['true', '1', 'yes']
+
+# Common latitude grid for all models as 'min,max,step' (e.g. '-90,90,5'),
+# models are interpolated to it at load time ('': keep original grids,
+# only sorted in ascending order)
+O3AS_DATA_LAT_GRID = os.getenv('O3AS_DATA_LAT_GRID', '')
+
+# Data types to load at start (comma separated), others are loaded
+# when first requested
+O3AS_DATA_PRELOAD = [ t.strip() for t in
+                      os.getenv('O3AS_DATA_PRELOAD', 'tco3_zm').split(',')
+                      if len(t.strip()) > 0 ]
+
+# Load data in the background at start, i.e. the API answers
+# (/health, /ready) while data is loading
+O3AS_DATA_LOAD_BACKGROUND = os.getenv('O3AS_DATA_LOAD_BACKGROUND', 'True').lower() in ['true', '1', 'yes']
+
+# Retry-After (sec) for requests to data endpoints, while data is loading
+O3AS_DATA_RETRY_AFTER = int(os.getenv('O3AS_DATA_RETRY_AFTER', 10))
+
+# Interval (sec) to check O3AS_DATA_BASEPATH for new or changed datafiles
+# and reload them (0: no polling)
+O3AS_DATA_RELOAD_INTERVAL = int(os.getenv('O3AS_DATA_RELOAD_INTERVAL', 0))
+
+# Token to authorize admin endpoints, e.g. data reload (empty: disabled)
+O3AS_ADMIN_TOKEN = os.getenv('O3AS_ADMIN_TOKEN', '')
+
+# Number of reference values (with the yearly reference series) to keep
+# for further requests (0: no cache)
+O3AS_REF_CACHE_SIZE = int(os.getenv('O3AS_REF_CACHE_SIZE', 32))
+
+# Number of smoothed and shifted series of single models to keep
+# for further requests (0: no cache)
+O3AS_SERIES_CACHE_SIZE = int(os.getenv('O3AS_SERIES_CACHE_SIZE', 1024))
+
 # minimum number of years after the Reference Year:
 O3AS_TCO3Return_REF_YEAR_MARGIN = 5
 # boxcar smoothing parameter:
@@ -50,6 +117,16 @@ O3AS_TCO3Return_BOXCAR_WINDOW = 10
 # minimum and maximum year interval for TCO3Return:
 O3AS_TCO3Return_BEGIN_YEAR=1959
 O3AS_TCO3Return_END_YEAR=2100
+# compute tco3_return series of all models for the default regions and
+# the default reference at load time (and after every reload)
+O3AS_TCO3Return_PRECOMPUTE = os.getenv('O3AS_TCO3Return_PRECOMPUTE',
+                                       'True').lower() in ['true', '1', 'yes']
+# default reference, same as the defaults in swagger.yml
+O3AS_TCO3Return_DEFAULT_REF = {
+    'ref_meas': 'SBUV_GSFC_observed-merged-SAT-ozone',
+    'ref_year': 1980,
+    'ref_fillna': False
+}
 
 
 # list of trusted OIDC providers
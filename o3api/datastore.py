@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 - 2022 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+
+"""
+Module with the DataStore class to keep loaded data and reload it
+"""
+
+import logging
+import o3api.config as cfg
+import o3api.load as o3load
+import os
+import threading
+import time
+
+from collections.abc import Mapping
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+
+class DataStore(Mapping):
+    """Class to keep loaded data as {'plot type': DatasetEnsemble}.
+    Plot types in preload are loaded by :meth:`start` (optionally in
+    the background), others when they are first requested.
+    Iteration goes over loaded plot types only.
+    Data can be reloaded: only new or changed datafiles are loaded,
+    then the updated ensemble is swapped in at once, i.e. requests in
+    progress keep using the ensemble they started with.
+
+    :param data_basepath: Base path for data
+    :param plot_types: Plot types to provide (e.g. tco3_zm, vmro3_zm)
+    :param preload: Plot types to load at start (default: all plot_types)
+    :param prepare: Function called as prepare(plot type, DatasetEnsemble)
+                    after the plot type is loaded or reloaded, e.g. to
+                    precompute results (optional)
+    """
+
+    def __init__(self, data_basepath, plot_types, preload=None, prepare=None):
+        """Constructor method
+        """
+        self.data_basepath = data_basepath
+        self.plot_types = list(plot_types)
+        self.preload = list(self.plot_types if preload is None else preload)
+        unknown = [ ptype for ptype in self.preload
+                    if ptype not in self.plot_types ]
+        if len(unknown) > 0:
+            raise ValueError(F"Plot types to preload {unknown} are not " +
+                             F"in the plot types {self.plot_types}")
+        self.prepare = prepare
+        # number of data updates, incremented on every swap
+        self.generation = 0
+        self._data = {}
+        self._reload_lock = threading.Lock()
+        self._load_locks = { ptype: threading.Lock() for ptype in self.plot_types }
+        # set when loading at start is finished (or failed)
+        self._loaded = threading.Event()
+        self._loading = None
+        self._polling = None
+        self._polling_interval = 0
+        # process which started loading, see restart()
+        self._pid = None
+        self.progress = {}
+
+        # locks may be copied as held by fork(), threads are not copied
+        os.register_at_fork(after_in_child=self.__after_fork)
+
+    def __getitem__(self, ptype):
+        data = self._data
+        if ptype not in data:
+            if ptype not in self._load_locks:
+                raise KeyError(ptype)
+            data = self.__load(ptype)
+
+        return data[ptype]
+
+    def __load(self, ptype, progress=None):
+        """Load the plot type, if it is not loaded yet.
+        Other threads requesting the same plot type wait for it.
+
+        :param ptype: Plot type
+        :param progress: function called after every loaded model (optional)
+        :return: loaded data as {'plot type': DatasetEnsemble}
+        """
+        with self._load_locks[ptype]:
+            if ptype not in self._data:
+                loader = o3load.LoadData(self.data_basepath, ptype)
+                ds_ensemble = loader.load_dataset_ensemble(progress=progress)
+                with self._reload_lock:
+                    self._data = dict(self._data, **{ptype: ds_ensemble})
+                self.__prepare(ptype, ds_ensemble)
+
+            return self._data
+
+    def __prepare(self, ptype, ds_ensemble):
+        """Call self.prepare for the loaded data, errors are only logged
+        """
+        if self.prepare is None:
+            return
+
+        try:
+            self.prepare(ptype, ds_ensemble)
+        except Exception as e:
+            logger.error(F"[PREPARE] {ptype}: failed ({e})", exc_info=True)
+
+    def __update_progress(self, model, ds):
+        """Count models and bytes loaded at start
+        """
+        self.progress['models_loaded'] += 1
+        self.progress['bytes_loaded'] += ds.nbytes
+
+    def __load_preload(self):
+        """Load all plot types in self.preload, set ready when done
+        """
+        try:
+            loaders = [ o3load.LoadData(self.data_basepath, ptype)
+                        for ptype in self.preload ]
+            self.progress['models_total'] = sum(len(l.get_datafile_paths())
+                                                for l in loaders)
+            for ptype in self.preload:
+                self.__load(ptype, progress=self.__update_progress)
+            self.progress['time_ready'] = time.time()
+        except Exception as e:
+            self.progress['error'] = str(e)
+            logger.critical(F"[START] data loading failed: {e}", exc_info=True)
+        finally:
+            self._loaded.set()
+
+        if self.is_ready():
+            logger.info(F"[START] data is loaded: {self.get_status()}")
+
+    def start(self, background=False):
+        """Load plot types in self.preload
+
+        :param background: If True, load in a background thread and return
+                           immediately, see :meth:`is_ready`
+        """
+        if self._loading is not None:
+            return
+
+        self._pid = os.getpid()
+        self.progress = {'models_loaded': 0, 'models_total': 0,
+                         'bytes_loaded': 0, 'time_start': time.time(),
+                         'time_ready': None, 'error': None}
+        if background:
+            self._loading = threading.Thread(target=self.__load_preload,
+                                             name='o3start', daemon=True)
+            self._loading.start()
+        else:
+            self._loading = threading.current_thread()
+            self.__load_preload()
+
+    def is_ready(self):
+        """Check if plot types in self.preload are loaded
+
+        :return: True if loaded
+        """
+        return self._loaded.is_set() and self.progress['error'] is None
+
+    def wait_ready(self, timeout=None):
+        """Wait until plot types in self.preload are loaded
+
+        :param timeout: Time to wait (sec), None to wait until loaded
+        :return: True if loaded
+        """
+        self._loaded.wait(timeout)
+
+        return self.is_ready()
+
+    def get_status(self):
+        """Return the status of loading at start
+
+        :return: ready, loaded plot types, models and bytes loaded,
+                 elapsed time (sec), error (if loading failed)
+        :rtype: dict
+        """
+        progress = dict(self.progress)
+        time_start = progress.get('time_start')
+        if time_start is not None:
+            elapsed = (progress['time_ready'] or time.time()) - time_start
+        else:
+            elapsed = 0.
+
+        return {'ready': self.is_ready(),
+                'plot_types': list(self._data.keys()),
+                'models_loaded': progress.get('models_loaded', 0),
+                'models_total': progress.get('models_total', 0),
+                'bytes_loaded': progress.get('bytes_loaded', 0),
+                'elapsed': round(elapsed, 3),
+                'error': progress.get('error')}
+
+    def __contains__(self, ptype):
+        return ptype in self.plot_types
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __after_fork(self):
+        """Re-initialize locks in a forked process. Threads (loading,
+        polling) are not started here, as every fork, e.g. of 'process'
+        loader workers, would start loading again, see :meth:`restart`
+        """
+        self._reload_lock = threading.Lock()
+        self._load_locks = { ptype: threading.Lock() for ptype in self.plot_types }
+        loaded = self._loaded.is_set()
+        self._loaded = threading.Event()
+        if loaded:
+            self._loaded.set()
+        else:
+            self._loading = None
+        self._polling = None
+
+    def restart(self):
+        """Restart loading (if it was not finished) and polling in a process
+        forked from the one which started the store, e.g. in a gunicorn
+        worker (see post_fork in gunicorn.conf.py)
+        """
+        if self._pid is None or self._pid == os.getpid():
+            return
+
+        if not self._loaded.is_set():
+            self.start(background=True)
+        self.start_polling(self._polling_interval)
+
+    def is_loaded(self, ptype):
+        """Check if the plot type is already loaded
+
+        :param ptype: Plot type
+        :return: True if loaded
+        """
+        return ptype in self._data
+
+    def reload(self):
+        """Reload data of loaded plot types: load only new or changed
+        datafiles and swap the updated ensembles in
+
+        :return: summary of changes per plot type and the data generation
+        :rtype: dict
+        """
+        time_start = time.time()
+        changes = {}
+        with self._reload_lock:
+            data_new = dict(self._data)
+            for ptype, ds_ensemble in list(data_new.items()):
+                loader = o3load.LoadData(self.data_basepath, ptype)
+                data_new[ptype] = loader.load_dataset_ensemble(previous=ds_ensemble)
+                changes[ptype] = loader.changes
+
+            updated = [ pt for pt in data_new if data_new[pt] is not self._data[pt] ]
+            if len(updated) > 0:
+                # single reference assignment, i.e. atomic swap
+                self._data = data_new
+                self.generation += 1
+            for ptype in updated:
+                self.__prepare(ptype, data_new[ptype])
+
+        logger.info(F"[RELOAD] generation {self.generation}: {changes} " +
+                    F"({time.time() - time_start:.2f}s)")
+
+        return {'generation': self.generation, 'changes': changes}
+
+    def start_polling(self, interval):
+        """Start the thread to reload data every interval seconds
+
+        :param interval: Time between reloads (sec), 0 to not poll
+        """
+        self._polling_interval = interval
+        if interval <= 0 or self._polling is not None:
+            return
+
+        def _poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(F"[RELOAD] failed: {e}", exc_info=True)
+
+        thread = threading.Thread(target=_poll, name='o3reload', daemon=True)
+        self._polling = (thread, interval)
+        thread.start()
@@ -41,4 +41,30 @@ def _timeit(func):
         time_diff = time_described - time_model
         print(F"[TIME] Function {func.__name__} needed: {time_diff}")
         return f
-    return wrap
\ No newline at end of file
+    return wrap
+
+
+def get_memory_usage(pid='self'):
+    """Return resident memory of the process, split into shared and private
+    parts (from /proc/<pid>/smaps_rollup, Linux only).
+    Useful to check that gunicorn workers share preloaded data.
+
+    :param pid: Process ID, 'self' for the current process
+    :return: {'rss', 'pss', 'shared', 'private'} in bytes
+    :rtype: dict
+    """
+    fields = {}
+    with open(F"/proc/{pid}/smaps_rollup", 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])*1024
+
+    memory = {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+    return memory
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 - 2022 Karlsruhe Institute of Technology - Steinbuch Centre for Computing
+# This code is distributed under the MIT License
+# Please, see the LICENSE file
+#
+# @author: vykozlov
+
+"""
+Module with three classes:
+
+* DatasetEnsemble, dictionary of datasets as {'model': xarray dataset}
+
+* ModelIndex, precomputed time and latitude index of one model
+
+* EnsembleCube, all models aligned in one models x months x lat array
+"""
+
+import itertools
+import json
+import logging
+import numpy as np
+import o3api.config as cfg
+import os
+import pandas as pd
+import tempfile
+
+logger = logging.getLogger('__name__') #o3api
+logger.setLevel(cfg.log_level)
+
+# configuration for netCDF
+TIME = cfg.netCDF_conf['t_c']
+LAT = cfg.netCDF_conf['lat_c']
+
+
+class DatasetEnsemble(dict):
+    """Dictionary of datasets as {'model': xarray dataset},
+    additionally holds:
+
+    * cube: the :class:`EnsembleCube` built from the datasets (or None)
+
+    * signatures: datafile signature for every model (path, size, mtime)
+
+    * version: unique number of the ensemble, changes when data is reloaded
+
+    * metadata: metadata of the original dataset for every model,
+      as in xarray.Dataset.to_dict(data=False) (only in the compact mode)
+
+    * nbytes: bytes held in memory for every model, by its dataset
+      and by its part of the ensemble cube
+
+    * lat_original: original latitudes of every model, i.e. before
+      they are sorted or interpolated to the common grid
+
+    * coverage: time and latitude range with valid values of every model,
+      as {'time_min', 'time_max', 'lat_min', 'lat_max'}
+
+    * model_indexes: :class:`ModelIndex` of every model (or None)
+    """
+
+    _versions = itertools.count(1)
+
+    def __init__(self, *args, **kwargs):
+        """Constructor method
+        """
+        super().__init__(*args, **kwargs)
+        self.cube = None
+        self.signatures = {}
+        self.version = next(self._versions)
+        self.metadata = {}
+        self.nbytes = {}
+        self.lat_original = {}
+        self.coverage = {}
+        self.model_indexes = {}
+
+
+def get_lat_slice(lat, lat_min, lat_max):
+    """Return the slice of ascending latitudes within [lat_min, lat_max]
+
+    :param lat: Latitude values, ascending
+    :param lat_min: Minimum latitude
+    :param lat_max: Maximum latitude
+    :return: slice along the latitude axis
+    """
+    i_min = np.searchsorted(lat, lat_min, side='left')
+    i_max = np.searchsorted(lat, lat_max, side='right')
+
+    return slice(i_min, max(i_min, i_max))
+
+
+class ModelIndex:
+    """Class to select time steps and latitudes of one model
+    by integer positions, built once at load time:
+    time axis converted to pandas.DatetimeIndex, year -> offset table,
+    month masks and latitudes (ascending) for searchsorted.
+
+    :param time: Time axis of the model, ascending
+    :param lat: Latitude values of the model, ascending
+    """
+
+    def __init__(self, time, lat):
+        """Constructor method
+        """
+        self.time = pd.DatetimeIndex(time)
+        self.lat = np.asarray(lat)
+        years = np.asarray(self.time.year)
+        months = np.asarray(self.time.month)
+        self.year0 = years[0] if len(years) > 0 else 0
+        # time steps of year y are [year_offsets[y - year0], year_offsets[y - year0 + 1])
+        year_last = years[-1] if len(years) > 0 else -1
+        self.year_offsets = np.searchsorted(years,
+                                            np.arange(self.year0, year_last + 2))
+        # month_masks[m - 1]: time steps in the month m
+        self.month_masks = np.stack([ months == m for m in range(1, 13) ])
+        # month of every time step, e.g. to align models on one month axis
+        self.months = self.time.values.astype('datetime64[M]')
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """Build the index of the dataset
+
+        :param ds: xarray Dataset with the model data
+        :return: ModelIndex or None, if time or latitude are not ascending
+        """
+        time = ds.indexes[TIME]
+        if not isinstance(time, pd.DatetimeIndex):
+            time = time.to_datetimeindex()
+        lat = ds.coords[LAT].values
+        if (not time.is_monotonic_increasing or
+            not np.all(np.diff(lat) > 0)):
+            return None
+
+        return cls(time, lat)
+
+    def get_time_indices(self, begin, end, months=[]):
+        """Return positions of time steps in the [begin, end] years interval
+
+        :param begin: First year
+        :param end: Last year
+        :param months: Months to select (1..12), all months if empty
+        :return: slice (all months) or array of positions along time
+        """
+        n_offsets = len(self.year_offsets)
+        i_begin = self.year_offsets[min(max(begin - self.year0, 0), n_offsets - 1)]
+        i_end = self.year_offsets[min(max(end - self.year0 + 1, 0), n_offsets - 1)]
+        if len(months) == 0:
+            return slice(i_begin, max(i_begin, i_end))
+
+        mask = self.month_masks[np.asarray(months) - 1, i_begin:i_end].any(axis=0)
+        return np.flatnonzero(mask) + i_begin
+
+    def get_lat_slice(self, lat_min, lat_max):
+        """Return the slice of latitudes within [lat_min, lat_max]
+
+        :param lat_min: Minimum latitude
+        :param lat_max: Maximum latitude
+        :return: slice along the latitude axis
+        """
+        return get_lat_slice(self.lat, lat_min, lat_max)
+
+
+class EnsembleCube:
+    """Class to hold all models aligned in one array:
+    models x months x lat. Months are counted from January of the first
+    year found in the data, latitudes are sorted in ascending order and
+    are the union of latitudes of all models.
+    Values not provided by a model are NaN.
+    Cumulative sums and counts of valid values along latitude are kept,
+    i.e. the mean over any latitude band is a difference of two entries.
+
+    :param models: List of models (first axis of the array)
+    :param lat: Latitude values (last axis of the array)
+    :param year0: Year of the first month
+    :param data: Array of values, models x months x lat (None if
+                 dropped, requests use only the cumulative sums)
+    :param mask: Validity mask, models x months, True if the model has
+                 a time step in the month
+    :param lat_cumsum: Cumulative sum of valid values along latitude,
+                       models x months x (lat+1), calculated if None
+    :param lat_count: Cumulative count of valid values along latitude,
+                      models x months x (lat+1), calculated if None
+    """
+
+    # arrays stored by save()
+    _arrays = ['data', 'mask', 'lat', 'lat_cumsum', 'lat_count']
+    # version of the stored format, changes if _arrays change
+    format_version = 2
+
+    def __init__(self, models, lat, year0, data, mask,
+                 lat_cumsum=None, lat_count=None):
+        """Constructor method
+        """
+        self.models = list(models)
+        self.model_index = { m: i for i, m in enumerate(self.models) }
+        self.lat = lat
+        self.year0 = year0
+        self.data = data
+        self.mask = mask
+        if lat_cumsum is None or lat_count is None:
+            lat_cumsum, lat_count = self.get_lat_cumsum(data)
+        self.lat_cumsum = lat_cumsum
+        self.lat_count = lat_count
+        n_months = self.data.shape[1]
+        # time axis (beginning of every month), converted only once
+        self.time = pd.DatetimeIndex(
+            np.datetime64(F"{year0}-01", 'M') + np.arange(n_months),
+            name=TIME)
+
+    @classmethod
+    def from_datasets(cls, ds_ensemble, variable, dtype=np.float64):
+        """Build the cube from the dictionary of datasets
+
+        :param ds_ensemble: dictionary of datasets as {'model': xarray dataset}
+        :param variable: Variable to put in the cube, e.g. tco3_zm
+        :param dtype: Data type of the cube
+        :return: EnsembleCube or None, if the variable is not (time, lat)
+        """
+        if len(ds_ensemble) == 0:
+            return None
+
+        for model, ds in ds_ensemble.items():
+            if (variable not in ds.data_vars or
+                set(ds[variable].dims) != set([TIME, LAT])):
+                logger.info(F"{model}: {variable} is not ({TIME}, {LAT}), " +
+                            "ensemble cube is not built")
+                return None
+
+        # find months (counted from year0) and latitudes of every model
+        times = { m: ds.indexes[TIME] for m, ds in ds_ensemble.items() }
+        year0 = min(t.year.min() for t in times.values() if len(t) > 0)
+        year_last = max(t.year.max() for t in times.values() if len(t) > 0)
+        lat = np.unique(np.concatenate(
+            [ ds.coords[LAT].values for ds in ds_ensemble.values() ]))
+
+        n_months = (year_last - year0 + 1) * 12
+        data = np.full((len(ds_ensemble), n_months, len(lat)), np.nan,
+                       dtype=dtype)
+        mask = np.zeros((len(ds_ensemble), n_months), dtype=bool)
+
+        for i, (model, ds) in enumerate(ds_ensemble.items()):
+            t = times[model]
+            month_idx = (np.asarray(t.year) - year0) * 12 + np.asarray(t.month) - 1
+            if len(np.unique(month_idx)) < len(month_idx):
+                logger.warning(F"{model}: more than one time step per month, " +
+                               "the last one is used")
+            lat_idx = np.searchsorted(lat, ds.coords[LAT].values)
+            values = ds[variable].transpose(TIME, LAT).values
+            data[i, month_idx[:, np.newaxis], lat_idx[np.newaxis, :]] = values
+            mask[i, month_idx] = True
+
+        logger.debug(F"EnsembleCube ({variable}): {data.shape}, " +
+                     F"{data.nbytes} bytes")
+
+        return cls(ds_ensemble.keys(), lat, year0, data, mask)
+
+    def save(self, path):
+        """Store the cube in the directory as .npy files + index.json.
+        The directory is first written under a temporary name and then
+        renamed, i.e. readers never see a partially written cube.
+
+        :param path: Directory to store the cube (should not exist)
+        """
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.tmp-')
+        for name in self._arrays:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+            json.dump({'models': self.models, 'year0': int(self.year0)}, f)
+        os.rename(tmp_path, path)
+        logger.debug(F"EnsembleCube stored in {path}")
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load the cube stored by :meth:`save`
+
+        :param path: Directory with the stored cube
+        :param mmap_mode: 'r' to memory-map arrays read-only, None to read them
+        :return: EnsembleCube
+        """
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        arrays = { name: np.load(os.path.join(path, name + '.npy'),
+                                 mmap_mode=mmap_mode)
+                   for name in cls._arrays }
+        logger.debug(F"EnsembleCube loaded from {path} (mmap_mode={mmap_mode})")
+
+        return cls(index['models'], arrays['lat'], index['year0'],
+                   arrays['data'], arrays['mask'],
+                   arrays['lat_cumsum'], arrays['lat_count'])
+
+    @staticmethod
+    def get_lat_cumsum(data):
+        """Calculate cumulative sums and counts of valid (not NaN) values
+        along latitude, with a leading zero, i.e. for the band [i, j)
+        sum = cumsum[..., j] - cumsum[..., i]
+
+        :param data: Array of values, models x months x lat
+        :return: cumulative sum (float64), cumulative count (int16,
+                 latitude axis is short), both models x months x (lat+1)
+        """
+        valid = ~np.isnan(data)
+        shape = data.shape[:-1] + (data.shape[-1] + 1,)
+        lat_cumsum = np.zeros(shape, dtype=np.float64)
+        lat_count = np.zeros(shape, dtype=np.int16)
+        np.cumsum(np.where(valid, data, 0.), axis=-1, dtype=np.float64,
+                  out=lat_cumsum[..., 1:])
+        np.cumsum(valid, axis=-1, dtype=np.int16, out=lat_count[..., 1:])
+
+        return lat_cumsum, lat_count
+
+    def get_nbytes(self, model):
+        """Return bytes held by the arrays of the model
+
+        :param model: Model in the cube
+        :return: bytes
+        :rtype: int
+        """
+        i = self.model_index[model]
+
+        return sum(a[i].nbytes for a in [self.data, self.mask,
+                                         self.lat_cumsum, self.lat_count]
+                   if a is not None)
+
+    def get_month_indices(self, begin, end, months=[]):
+        """Return indices of months in the [begin, end] years interval
+
+        :param begin: First year
+        :param end: Last year
+        :param months: Months to select (1..12), all months if empty
+        :return: indices of months along the month axis
+        :rtype: numpy.ndarray
+        """
+        i_begin = min(max((begin - self.year0) * 12, 0), len(self.time))
+        i_end = min(max((end - self.year0 + 1) * 12, 0), len(self.time))
+        month_idx = np.arange(i_begin, i_end)
+        if len(months) > 0:
+            month_idx = month_idx[np.isin(month_idx % 12 + 1, months)]
+
+        return month_idx
+
+    def get_lat_slice(self, lat_min, lat_max):
+        """Return the slice of latitudes within [lat_min, lat_max]
+
+        :param lat_min: Minimum latitude
+        :param lat_max: Maximum latitude
+        :return: slice along the latitude axis
+        """
+        return get_lat_slice(self.lat, lat_min, lat_max)
+
+    def get_band_mean(self, models, month_idx, lat_min, lat_max):
+        """Average values over the latitude band, skipping NaNs.
+        Uses cumulative sums, i.e. does not depend on the band width
+
+        :param models: Models to process
+        :param month_idx: Indices of months to select
+        :param lat_min: Minimum latitude
+        :param lat_max: Maximum latitude
+        :return: band mean, models x months (NaN if no valid values)
+        :rtype: numpy.ndarray
+        """
+        model_idx = np.array([ self.model_index[m] for m in models ])
+        lat_slice = self.get_lat_slice(lat_min, lat_max)
+        rows = (model_idx[:, np.newaxis], np.asarray(month_idx)[np.newaxis, :])
+        band_sum = (self.lat_cumsum[rows + (lat_slice.stop,)] -
+                    self.lat_cumsum[rows + (lat_slice.start,)])
+        count = (self.lat_count[rows + (lat_slice.stop,)] -
+                 self.lat_count[rows + (lat_slice.start,)])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            band_mean = band_sum / count
+
+        return np.where(count > 0, band_mean, np.nan)
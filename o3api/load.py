@@ -11,16 +11,27 @@
 Module containing the LoadData class to initialize datasets and load them in-memory
 """
 
+import fcntl
 import glob
+import hashlib
+import json
+import multiprocessing
+import numpy as np
 import o3api.config as cfg
 import os
 import logging
+import shutil
+import threading
+import time
 import xarray as xr
 
 import cProfile
 import io
 import pstats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import wraps
+from o3api.cache import DataCache
+from o3api.ensemble import DatasetEnsemble, EnsembleCube, ModelIndex
 
 # to check size of data in the memory
 # https://github.com/pympler/pympler
@@ -43,6 +54,40 @@ logger = logging.getLogger('__name__') #__name__ #o3api
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s')
 logger.setLevel(logging.INFO)
 
+# netCDF/HDF5 libraries are not thread-safe:
+# datafiles are opened, read and closed by one thread at a time,
+# i.e. 'thread' workers do not read datafiles in parallel, 'process' ones do
+_netcdf_lock = threading.Lock()
+
+
+def _reset_netcdf_lock():
+    """Re-create the lock in a forked process, it is copied as held
+    if the parent forks while reading (or while submitting to 'process' workers)
+    """
+    global _netcdf_lock
+    _netcdf_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_netcdf_lock)
+
+
+def get_lat_grid(lat_grid):
+    """Return the common latitude grid
+
+    :param lat_grid: Latitude values or 'min,max,step' string
+                     (e.g. '-90,90,5'), '' or None for no common grid
+    :return: ascending latitude values or None
+    :rtype: numpy.ndarray
+    """
+    if lat_grid is None or len(lat_grid) == 0:
+        return None
+
+    if isinstance(lat_grid, str):
+        lat_min, lat_max, step = [ float(x) for x in lat_grid.split(',') ]
+        lat_grid = np.arange(lat_min, lat_max + step/2., step)
+
+    return np.sort(np.asarray(lat_grid, dtype=np.float64))
+
 
 def _profile(func):
     """Decorate function for profiling
@@ -66,9 +111,17 @@ class LoadData:
     """Base Class to initialize the dataset
 
     :param plot_type: The plot type (e.g. tco3_zm, tco3_return, vmro3_zm, ...)
+    :param workers: Number of parallel workers to load the datafiles
+    :param executor: Kind of workers, 'thread' or 'process'
+    :param cache_dir: Directory to cache decoded datasets ('' for no cache)
+    :param mmap_dir: Directory for memory-mapped ensemble cube ('' for no mmap)
+    :param compact: Keep only the plot type variable as float32 (see compact_dataset)
+    :param lat_grid: Common latitude grid for all models, either values or
+                     'min,max,step' ('' or None: keep the original grid)
     """
 
-    def __init__ (self, data_basepath, plot_type):
+    def __init__ (self, data_basepath, plot_type, workers=None, executor=None,
+                  cache_dir=None, mmap_dir=None, compact=None, lat_grid=None):
         """Constructor method
         """
         self.data_basepath = data_basepath
@@ -78,6 +131,18 @@ class LoadData:
         if plot_type == "tco3_return":
             self._data_pattern = "tco3*.nc"
         self._datafile_paths = [] #None
+        self.workers = workers if workers else cfg.O3AS_LOAD_WORKERS
+        self.executor = executor if executor else cfg.O3AS_LOAD_EXECUTOR
+        # time (sec) spent to load every model, as {'model': time}
+        self.load_timings = {}
+        cache_dir = cfg.O3AS_DATA_CACHE_DIR if cache_dir is None else cache_dir
+        self._cache = DataCache(cache_dir) if cache_dir else None
+        self.mmap_dir = cfg.O3AS_DATA_MMAP_DIR if mmap_dir is None else mmap_dir
+        self.compact = cfg.O3AS_DATA_COMPACT if compact is None else compact
+        self.lat_grid = get_lat_grid(cfg.O3AS_DATA_LAT_GRID
+                                     if lat_grid is None else lat_grid)
+        # tco3_return uses the same data as tco3_zm
+        self.variable = TCO3 if self.plot_type == TCO3Return else self.plot_type
 
     def __set_datafile_paths(self):
         """Set the list of datafile paths corresponding to 
@@ -90,28 +155,275 @@ class LoadData:
                                                       self._data_pattern))
         self._datafile_paths.sort()
 
+    def get_datafile_paths(self):
+        """Return the list of datafile paths corresponding to
+           the O3 plot type
+
+        :return: list of datafile paths
+        :rtype: list
+        """
+        self.__set_datafile_paths()
+
+        return list(self._datafile_paths)
+
     def load_dataset(self, model_path):
-        """Load dataset from the datafile path (one model)
+        """Load dataset from the datafile path (one model).
+        If the cache is configured, the decoded dataset is read from there
+        (or stored there, if there is no valid cache entry yet).
 
         :param model_path: Full path to the model data
         :return: xarray Dataset with the model data
         :rtype: xarray.Dataset
         """
-        ds = xr.open_dataset(model_path, 
-                             cache=True,  # True
-                             decode_cf=False) # decode_cf=False #faster?
+        if self._cache is not None:
+            ds = self._cache.get(model_path)
+            if ds is not None:
+                return ds
+
+        with _netcdf_lock:
+            ds = xr.open_dataset(model_path, 
+                                 cache=True,  # True
+                                 decode_cf=False) # decode_cf=False #faster?
+            # read values and close the file, unless values are taken
+            # from the memory-mapped ensemble cube (file is kept open)
+            if not self.mmap_dir or self._cache is not None:
+                ds.load()
+                ds.close()
         ds = xr.decode_cf(ds)
         # we are using monthly data, with the 'middle' date,
         # in this case converting with align_on='date' will not miss dates
         # see https://xarray.pydata.org/en/stable/generated/xarray.Dataset.convert_calendar.html
         ds = ds.convert_calendar('standard', TIME, align_on='date', use_cftime=False)
 
+        if self._cache is not None:
+            ds.load()
+            self._cache.put(model_path, ds)
+
+        return ds
+
+    def load_metadata(self, model):
+        """Read metadata of the model from its datafile without loading
+        values, e.g. if the plot type is not loaded yet
+
+        :param model: Model (directory name)
+        :return: metadata as in xarray.Dataset.to_dict(data=False),
+                 None if there is no datafile of the model
+        :rtype: dict
+        """
+        model_paths = sorted(glob.glob(os.path.join(self.data_basepath, model,
+                                                    self._data_pattern)))
+        if len(model_paths) == 0:
+            return None
+
+        # the last datafile is loaded for the model, see load_dataset_ensemble
+        with _netcdf_lock:
+            with xr.open_dataset(model_paths[-1], decode_cf=False) as ds:
+                ds = xr.decode_cf(ds)
+                ds = ds.convert_calendar('standard', TIME, align_on='date',
+                                         use_cftime=False)
+                metadata = ds.to_dict(data=False)
+
+        return metadata
+
+    def normalize_latitude(self, ds):
+        """Sort latitudes in ascending order and, if configured,
+        interpolate the dataset to the common latitude grid (self.lat_grid).
+        Points of the grid outside of the model latitudes are NaN.
+
+        :param ds: xarray Dataset with the model data
+        :return: xarray Dataset with normalized latitudes
+        :rtype: xarray.Dataset
+        """
+        lat = ds.coords[LAT].values
+        if len(lat) > 1 and not np.all(np.diff(lat) > 0):
+            ds = ds.sortby(LAT)
+
+        if (self.lat_grid is not None and
+            not np.array_equal(ds.coords[LAT].values, self.lat_grid)):
+            ds = ds.interp({LAT: self.lat_grid})
+
+        return ds
+
+    def get_coverage(self, ds):
+        """Find the time and latitude range with valid (not NaN) values
+        of the plot type variable
+
+        :param ds: xarray Dataset with the model data
+        :return: {'time_min', 'time_max', 'lat_min', 'lat_max'}, all None
+                 if there are no valid values, or None if there is
+                 no such variable
+        :rtype: dict
+        """
+        if self.variable not in ds.data_vars:
+            return None
+
+        valid = ds[self.variable].notnull()
+        valid_time = valid.any(dim=[ d for d in valid.dims if d != TIME ]).values
+        valid_lat = valid.any(dim=[ d for d in valid.dims if d != LAT ]).values
+        if not valid_time.any():
+            return dict.fromkeys(['time_min', 'time_max', 'lat_min', 'lat_max'])
+
+        time_valid = ds.indexes[TIME][valid_time]
+        lat_valid = ds.coords[LAT].values[valid_lat]
+
+        return {'time_min': time_valid.min(), 'time_max': time_valid.max(),
+                'lat_min': float(lat_valid.min()),
+                'lat_max': float(lat_valid.max())}
+
+    def compact_dataset(self, ds):
+        """Reduce memory used by the dataset: keep only the variable of
+        the plot type (as float32) and its dimension coordinates,
+        drop all attributes. Values are not converted if the dataset is
+        not loaded in memory (memory-mapped ensemble cube is used).
+
+        :param ds: xarray Dataset with the model data
+        :return: compacted xarray Dataset
+        :rtype: xarray.Dataset
+        """
+        ds = ds[[self.variable]]
+        ds = ds.drop_vars([ c for c in ds.coords if c not in ds.dims ])
+        if not self.mmap_dir:
+            ds[self.variable] = ds[self.variable].astype(np.float32)
+        ds.attrs = {}
+        for var in ds.variables.values():
+            var.attrs = {}
+
         return ds
-    
-    def load_dataset_ensemble(self):
+
+    def get_nbytes(self, ds):
+        """Return bytes held by the dataset in memory: values not loaded
+        (taken from the memory-mapped ensemble cube) are not counted
+
+        :param ds: xarray Dataset with the model data
+        :return: bytes
+        :rtype: int
+        """
+        if self.mmap_dir and self._cache is None:
+            return sum(ds[c].nbytes for c in ds.coords)
+
+        return ds.nbytes
+
+    def load_model(self, model_path):
+        """Load dataset of one model in memory, measure the time spent.
+        Latitudes are normalized (see normalize_latitude), in the compact mode
+        metadata of the original dataset is extracted before the dataset
+        is compacted.
+
+        :param model_path: Full path to the model data
+        :return: model name, xarray Dataset, loading time (sec),
+                 info about the dataset as
+                 {'lat': original latitudes,
+                  'metadata': dict (compact mode) or None,
+                  'coverage': see get_coverage}
+        """
+        time_start = time.time()
+        # find the name of dataset (directory name)
+        model = os.path.dirname(model_path).split("/")[-1]
+        ds = self.load_dataset(model_path)
+        # immediately load it in memory,
+        # unless values are taken from the memory-mapped ensemble cube
+        if not self.mmap_dir:
+            ds.load()
+
+        info = {'lat': ds.coords[LAT].values.copy(), 'metadata': None}
+        if self.compact:
+            info['metadata'] = ds.to_dict(data=False)
+        ds = self.normalize_latitude(ds)
+        info['coverage'] = self.get_coverage(ds)
+        if self.compact:
+            ds = self.compact_dataset(ds)
+
+        return model, ds, time.time() - time_start, info
+
+    def __get_cube_mmap(self, ds_ensemble, variable):
+        """Return the ensemble cube memory-mapped from self.mmap_dir.
+        The cube is built and stored only once per data version (datafile
+        paths, sizes and modification times), the first worker stores it,
+        others wait and then map the same files.
+
+        :param ds_ensemble: dictionary of datasets as {'model': xarray dataset}
+        :param variable: Variable to put in the cube, e.g. tco3_zm
+        :return: EnsembleCube with memory-mapped arrays or None
+        """
+        signatures = sorted(ds_ensemble.signatures.values())
+        dtype = np.dtype(self.__get_cube_dtype()).name
+        lat_grid = None if self.lat_grid is None else self.lat_grid.tolist()
+        data_hash = hashlib.sha1(json.dumps([EnsembleCube.format_version,
+                                             variable, dtype, lat_grid,
+                                             signatures]).encode(
+            'utf-8')).hexdigest()  # nosec B303
+        cube_prefix = self.plot_type + '-'
+        cube_path = os.path.join(self.mmap_dir, cube_prefix + data_hash)
+
+        os.makedirs(self.mmap_dir, exist_ok=True)
+        with open(os.path.join(self.mmap_dir, self.plot_type + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isdir(cube_path):
+                cube = EnsembleCube.from_datasets(ds_ensemble, variable,
+                                                  dtype=self.__get_cube_dtype())
+                if cube is None:
+                    return None
+                cube.save(cube_path)
+                del cube
+                # remove cubes of previous data versions. Workers still
+                # using them keep their mappings until they reload
+                for d in os.listdir(self.mmap_dir):
+                    d_path = os.path.join(self.mmap_dir, d)
+                    if (d.startswith(cube_prefix) and d_path != cube_path and
+                        os.path.isdir(d_path)):
+                        shutil.rmtree(d_path, ignore_errors=True)
+
+        return EnsembleCube.load(cube_path, mmap_mode='r')
+
+    def __load_lazy_datasets(self, ds_ensemble):
+        """Load values of datasets in memory (and compact them), if the
+        ensemble cube is not built in mmap mode, e.g. the plot type
+        variable is not (time, lat): there is no cube to take values from
+
+        :param ds_ensemble: DatasetEnsemble with datasets not loaded
+        """
+        for model, ds in ds_ensemble.items():
+            with _netcdf_lock:
+                ds = ds.load()
+            if self.compact:
+                ds[self.variable] = ds[self.variable].astype(np.float32)
+            ds_ensemble[model] = ds
+            ds_ensemble.nbytes[model] = ds.nbytes
+
+    def __get_cube_dtype(self):
+        """Return the data type of the ensemble cube (float32 in the compact mode)
+        """
+        return np.float32 if self.compact else np.float64
+
+    def __get_executor(self, n_datafiles):
+        """Create the pool of workers to load datafiles in parallel
+
+        :param n_datafiles: Number of datafiles to load
+        :return: concurrent.futures executor
+        """
+        workers = min(self.workers, n_datafiles)
+        if self.executor == 'process':
+            # 'fork' avoids re-importing o3api (and loading data) in children
+            return ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context('fork'))
+        else:
+            return ThreadPoolExecutor(max_workers=workers,
+                                      thread_name_prefix='o3load')
+
+    def load_dataset_ensemble(self, previous=None, progress=None):
         """Load data from the list of datafiles (self._datafile_paths) in memory.
+        Datafiles are loaded in parallel, if more than one worker is configured.
+        If the previously loaded ensemble is given, only new or changed
+        datafiles (path, size, modification time) are loaded,
+        datasets of unchanged ones are re-used.
 
-        :return: dictionary of datasets as {'model': xarray dataset }
+        :param previous: previously loaded DatasetEnsemble (optional)
+        :param progress: function called as progress(model, dataset)
+                         after every loaded model (optional)
+        :return: dictionary of datasets as {'model': xarray dataset },
+                 with the ensemble cube built (if configured).
+                 If nothing changed, the previous ensemble is returned.
+        :rtype: DatasetEnsemble
         """
 
         self.__set_datafile_paths()
@@ -119,17 +431,99 @@ class LoadData:
                        {self._datafile_paths}")
 
         # dictionary to hold all data as {'model': dataset}
-        ds_ensemble = {}
-        
+        ds_ensemble = DatasetEnsemble()
+        self.load_timings = {}
+        self.changes = {'added': [], 'updated': [], 'removed': []}
+        time_start = time.time()
+
+        # compare signatures of datafiles with the previous ones
+        signatures = {}
+        paths_to_load = []
+        previous_signatures = getattr(previous, 'signatures', {})
         for mp in self._datafile_paths:
-            # find the name of dataset (directory name)
             model = os.path.dirname(mp).split("/")[-1]
-            # build up the dictionary of corresponding datasets
-            ds_ensemble[model] = self.load_dataset(mp)
-            # immediately load it in memory
-            ds_ensemble[model].load()
-            
-        print(F"Loaded {len(ds_ensemble)} {self.plot_type} (zonal mean) models")
+            signatures[model] = DataCache.get_signature(mp)
+            if previous_signatures.get(model) != signatures[model]:
+                paths_to_load.append(mp)
+
+        models_loaded = []
+        if self.workers > 1 and len(paths_to_load) > 1:
+            # executor.map() returns results in the order of datafiles
+            with self.__get_executor(len(paths_to_load)) as executor:
+                # 'process' workers are forked when tasks are submitted:
+                # no other thread may be inside netCDF/HDF5 at that moment
+                with _netcdf_lock:
+                    models_iter = executor.map(self.load_model, paths_to_load)
+                for model_loaded in models_iter:
+                    models_loaded.append(model_loaded)
+                    if progress is not None:
+                        progress(*model_loaded[:2])
+        else:
+            for model_loaded in map(self.load_model, paths_to_load):
+                models_loaded.append(model_loaded)
+                if progress is not None:
+                    progress(*model_loaded[:2])
+
+        datasets_loaded = {}
+        for model, ds, load_time, info in models_loaded:
+            datasets_loaded[model] = ds
+            ds_ensemble.lat_original[model] = info['lat']
+            ds_ensemble.coverage[model] = info['coverage']
+            ds_ensemble.model_indexes[model] = ModelIndex.from_dataset(ds)
+            if info['metadata'] is not None:
+                ds_ensemble.metadata[model] = info['metadata']
+            self.load_timings[model] = load_time
+            logger.info(F"[TIME] {self.plot_type}, {model}: loaded in {load_time:.2f}s")
+
+        # build up the dictionary of corresponding datasets
+        for model in signatures.keys():
+            if model in datasets_loaded:
+                ds_ensemble[model] = datasets_loaded[model]
+                if model in previous_signatures:
+                    self.changes['updated'].append(model)
+                elif previous is not None:
+                    self.changes['added'].append(model)
+            else:
+                ds_ensemble[model] = previous[model]
+                ds_ensemble.lat_original[model] = previous.lat_original[model]
+                ds_ensemble.coverage[model] = previous.coverage[model]
+                ds_ensemble.model_indexes[model] = previous.model_indexes[model]
+                if model in previous.metadata:
+                    ds_ensemble.metadata[model] = previous.metadata[model]
+            ds_ensemble.nbytes[model] = self.get_nbytes(ds_ensemble[model])
+        self.changes['removed'] = [ m for m in previous_signatures.keys()
+                                    if m not in signatures ]
+        ds_ensemble.signatures = signatures
+
+        if (previous is not None and
+            not any(len(c) > 0 for c in self.changes.values())):
+            logger.info(F"{self.plot_type}: no changes in datafiles")
+            return previous
+
+        # the memory-mapped cube is where values are taken from in mmap mode
+        if cfg.O3AS_ENSEMBLE_CUBE or self.mmap_dir:
+            if self.mmap_dir and len(ds_ensemble) > 0:
+                ds_ensemble.cube = self.__get_cube_mmap(ds_ensemble,
+                                                        self.variable)
+                if ds_ensemble.cube is None:
+                    self.__load_lazy_datasets(ds_ensemble)
+            else:
+                ds_ensemble.cube = EnsembleCube.from_datasets(
+                    ds_ensemble, self.variable, dtype=self.__get_cube_dtype())
+                # requests use only cumulative sums, values are in datasets
+                if self.compact and ds_ensemble.cube is not None:
+                    ds_ensemble.cube.data = None
+            if ds_ensemble.cube is not None:
+                for model in ds_ensemble.cube.models:
+                    ds_ensemble.nbytes[model] += ds_ensemble.cube.get_nbytes(model)
+
+        logger.info(F"[MEMORY] {self.plot_type}: " +
+                    F"{sum(ds_ensemble.nbytes.values())/2**20:.1f}MB " +
+                    F"in datasets and cube (compact: {self.compact})")
+        print(F"Loaded {len(models_loaded)} of {len(ds_ensemble)} " +
+              F"{self.plot_type} (zonal mean) models " +
+              F"in {time.time() - time_start:.2f}s " +
+              F"({self.workers} {self.executor} worker(s))")
 
         return ds_ensemble
 
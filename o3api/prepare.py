@@ -14,7 +14,11 @@ Module with the PreparaData class to perform data selection
 import logging
 import numpy as np
 import o3api.config as cfg
+import os
 import pandas as pd
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger('__name__') #o3api
 logger.setLevel(cfg.log_level)
@@ -29,6 +33,66 @@ TCO3Return = cfg.netCDF_conf['tco3_r']
 # configuration for API
 api_c = cfg.api_conf
 
+# thread pool shared by all requests to process models (or tco3_return
+# regions) concurrently, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+# number of tasks submitted to the pool, which wait for a free thread
+_tasks_queued = 0
+
+
+def _reset_executor():
+    """Drop the thread pool in a forked process (threads are not copied)
+    """
+    global _executor, _executor_lock, _tasks_queued
+    _executor = None
+    _executor_lock = threading.Lock()
+    _tasks_queued = 0
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+def get_executor_status():
+    """Return the size of the shared thread pool and its queue depth
+
+    :return: number of threads, number of tasks waiting for a thread
+    :rtype: dict
+    """
+    return {'workers': max(cfg.O3AS_PROCESS_WORKERS, 1),
+            'tasks_queued': _tasks_queued}
+
+
+def map_tasks(func, tasks):
+    """Apply the function to every task (e.g. model). If
+    O3AS_PROCESS_WORKERS > 1, tasks are processed concurrently in
+    the shared thread pool (NumPy and xarray reductions release the GIL)
+
+    :param func: Function to apply, func(task)
+    :param tasks: Tasks to process
+    :return: list of results, in the order of tasks
+    :rtype: list
+    """
+    global _executor, _tasks_queued
+    # threads of the pool do not wait for the pool, i.e. no deadlock
+    if (cfg.O3AS_PROCESS_WORKERS <= 1 or len(tasks) < 2 or
+        threading.current_thread().name.startswith('o3process')):
+        return list(map(func, tasks))
+
+    def _run(task):
+        global _tasks_queued
+        with _executor_lock:
+            _tasks_queued -= 1
+        return func(task)
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=cfg.O3AS_PROCESS_WORKERS,
+                                           thread_name_prefix='o3process')
+        _tasks_queued += len(tasks)
+
+    return list(_executor.map(_run, tasks))
+
 
 class PrepareData():
     """Class to perform data selection, based on :class:`Dataset`.
@@ -50,30 +114,76 @@ class PrepareData():
         self.month = kwargs[api_c['month']]
         self.lat_min = kwargs[api_c['lat_min']]
         self.lat_max = kwargs[api_c['lat_max']]
+        # aligned models x months x lat array, if built at load time
+        self._cube = getattr(data, 'cube', None)
+        # time and latitude range with valid values, built at load time
+        self._coverage = getattr(data, 'coverage', {})
+        # per-model time and latitude indexes, built at load time
+        self._model_indexes = getattr(data, 'model_indexes', {})
 
-    def __check_latitude_order(self, ds):
-        """Function to check the latitude order, 
-        returns them correctly ordered
+    def __get_months(self):
+        """Function to check the requested months
 
-        :param ds: xarray dataset to check
-        :return: lat_0, lat_last
+        :return: list of months to select, empty list for the whole year
         """
-        # check in what order latitude is used, e.g. (-90..90) or (90..-90)
-        lat_0 = np.amin(ds.coords[LAT].values[0]) # min latitude
-        lat_last = np.amax(ds.coords[LAT].values[-1]) # max latitude
-
-        if lat_0 < lat_last:
-            lat_a = self.lat_min
-            lat_b = self.lat_max
-        else:
-            lat_a = self.lat_max
-            lat_b = self.lat_min
-
-        return lat_a, lat_b
-       
+        if len(self.month) > 0:
+            if all(x in range(1,13) for x in self.month):
+                return self.month
+            else:
+                logger.warning(F"Wrong month number! Using whole year range.\
+                Check values: {self.month}.")
+
+        return []
+
+    def is_covered(self, model):
+        """Check if the model has valid values within the requested years
+        and latitudes, according to the coverage built at load time
+
+        :param model: The model to check
+        :return: False if the model has no valid values for the request,
+                 True otherwise (also if the coverage is not known)
+        """
+        coverage = self._coverage.get(model)
+        if coverage is None:
+            return True
+        if coverage['time_min'] is None:
+            return False
+
+        return (coverage['time_min'].year <= self.end and
+                coverage['time_max'].year >= self.begin and
+                coverage['lat_min'] <= self.lat_max and
+                coverage['lat_max'] >= self.lat_min)
+
+    def get_coverage_years(self, model):
+        """Return the first and last year with valid values of the model,
+        within the requested years
+
+        :param model: The model
+        :return: (first year, last year) or None if the coverage is not known
+        """
+        coverage = self._coverage.get(model)
+        if coverage is None or coverage['time_min'] is None:
+            return None
+
+        return (max(coverage['time_min'].year, self.begin),
+                min(coverage['time_max'].year, self.end))
+
+    def __get_index_selection(self, model_index):
+        """Find positions of the requested time steps and latitudes
+
+        :param model_index: ModelIndex of the model
+        :return: time positions (slice or array), latitude slice
+        """
+        time_idx = model_index.get_time_indices(self.begin, self.end,
+                                                self.__get_months())
+        lat_slice = model_index.get_lat_slice(self.lat_min, self.lat_max)
+
+        return time_idx, lat_slice
+
     def get_dataslice(self, model):
         """Function to select the slice of model data according 
-        to the time and latitude requested
+        to the time and latitude requested. Latitudes are in ascending
+        order, as normalized at load time (see LoadData.normalize_latitude)
 
         :param model: The model to process
         :return: xarray dataset selected according to the time and latitude
@@ -81,29 +191,29 @@ class PrepareData():
         """
         ds = self.data[model]
         logger.debug(F"{model}: Dataset is loaded from the storage location")
-        
-        # check in what order latitude is used, return them correspondently
-        lat_a, lat_b = self.__check_latitude_order(ds)
+
+        model_index = self._model_indexes.get(model)
+        if model_index is not None:
+            # integer positions from the index built at load time
+            time_idx, lat_slice = self.__get_index_selection(model_index)
+            return ds.isel({TIME: time_idx, LAT: lat_slice})
 
         # select data according to the period and latitude
         # BUG(?) ccmi-umukca-ucam complains about 31-12-year, but 30-12-year works
         # CFTime360day date format has 30 days for every month???
         # {}-01-01T00:00:00 .. {}-12-30T23:59:59
-        if len(self.month) > 0:
-            if all(x in range(1,13) for x in self.month):
-                ds = ds.sel(time=ds.time.dt.month.isin(self.month))
-            else:
-                logger.warning(F"Wrong month number! Using whole year range.\
-                Check values: {self.month}.")
+        months = self.__get_months()
+        if len(months) > 0:
+            ds = ds.sel(time=ds.time.dt.month.isin(months))
 
         ds_slice = ds.sel(time=slice(F"{self.begin}-01", 
                                      F"{self.end}-12"),
-                          lat=slice(lat_a,
-                                    lat_b))  # latitude
+                          lat=slice(self.lat_min,
+                                    self.lat_max))  # latitude
         #print("get_dataslice:", model, ds)
         # maybe skip years selection here? performance?
-        #ds_slice = ds.sel(lat=slice(lat_a,
-        #                            lat_b))  # latitude
+        #ds_slice = ds.sel(lat=slice(self.lat_min,
+        #                            self.lat_max))  # latitude
 
         # One may resample here per year, but seems:
         # 1. differ from Pandas, not clear why?
@@ -111,23 +221,25 @@ class PrepareData():
         #ds_slice.resample(time="A").mean()
         return ds_slice
 
-    def to_pd_dataframe(self, ds, model) -> pd.DataFrame:
+    def to_pd_dataframe(self, ds, model, time_axis=None) -> pd.DataFrame:
         """Convert xarray variable to pandas dataframe (faster method?)
         
         :param ds: xarray dataset
         :param model: The model to process for self.plot_type
+        :param time_axis: Time axis of ds, if already converted (optional)
         :return: dataset as pandas dataframe
         :rtype: pandas dataframe
         """
 
         # convert to pandas series to keep date information
         # different time axes should be harmonized in o3skim.. 
-        if (type(ds.indexes[TIME]) is 
-            pd.core.indexes.datetimes.DatetimeIndex) :
-            time_axis = ds.indexes[TIME].values
-        else:
-            # convert CFTimeIndex to pd.DatetimeIndex, turn Warnings Off (unsafe=True)
-            time_axis = ds.indexes[TIME].to_datetimeindex()
+        if time_axis is None:
+            if (type(ds.indexes[TIME]) is 
+                pd.core.indexes.datetimes.DatetimeIndex) :
+                time_axis = ds.indexes[TIME].values
+            else:
+                # convert CFTimeIndex to pd.DatetimeIndex, turn Warnings Off (unsafe=True)
+                time_axis = ds.indexes[TIME].to_datetimeindex()
 
         pd_model = pd.DataFrame({ model: np.nan_to_num(ds[self.plot_type]),
                                   'time': time_axis}).replace({0: np.nan})
@@ -148,7 +260,13 @@ class PrepareData():
         ds_plot_type = ds_slice[[self.plot_type]].mean(dim=[LAT])
         logger.debug("ds_plot_type: {}".format(ds_plot_type))
 
-        data = self.to_pd_dataframe(ds_plot_type, model)
+        time_axis = None
+        model_index = self._model_indexes.get(model)
+        if model_index is not None:
+            # time axis converted at load time
+            time_axis = model_index.time[self.__get_index_selection(model_index)[0]]
+
+        data = self.to_pd_dataframe(ds_plot_type, model, time_axis)
         return data
 
     def get_raw_ensemble_pd(self, models) -> pd.DataFrame:
@@ -167,13 +285,29 @@ class PrepareData():
         :return: ensemble of models as pd.DataFrame
         :rtype: pd.DataFrame
         """
+        # models without valid values for the request are not processed,
+        # but still returned (NaN)
+        models_covered = [ m for m in models if self.is_covered(m) ]
+        if 0 < len(models_covered) < len(models):
+            logger.debug("Not covered by data: " +
+                         F"{[ m for m in models if m not in models_covered ]}")
+            data = self.get_raw_ensemble_pd(models_covered)
+            return data.reindex(columns=models)
+
+        if (self._cube is not None and
+            all(m in self._cube.model_index and
+                self._model_indexes.get(m) is not None for m in models)):
+            return self.get_raw_ensemble_cube(models)
 
-        data = self.get_raw_data_pd(models[0]) # initialize with first model
+        if all(self.__is_batch_possible(m) for m in models):
+            return self.get_raw_ensemble_batch(models)
+
+        data_list = map_tasks(self.get_raw_data_pd, models)
+        data = data_list[0] # initialize with first model
         if len(models) > 1:
             ## PERFORMANCE? map() and join should be faster than 'for' and merge
             # how="outer" is important in order to keep all indecies/dates
-            data_list = map(self.get_raw_data_pd, models[1:])
-            data = data.join(data_list, how="outer")
+            data = data.join(data_list[1:], how="outer")
 
             ## previous method uses merge
             #for m in models[1:]:
@@ -183,3 +317,100 @@ class PrepareData():
             ##
 
         return data.sort_index()
+
+    def __is_batch_possible(self, model):
+        """Check if the model can be processed by get_raw_ensemble_batch(),
+        i.e. it has the index and the variable is (time, lat)
+        """
+        ds = self.data[model]
+        return (self._model_indexes.get(model) is not None and
+                self.plot_type in ds.data_vars and
+                set(ds[self.plot_type].dims) == set([TIME, LAT]))
+
+    def __get_band_mean(self, model):
+        """Select the model data by its index and
+        average it over the latitude band, skipping NaNs
+
+        :param model: The model to process
+        :return: selected time steps, band mean values
+        """
+        model_index = self._model_indexes[model]
+        time_idx, lat_slice = self.__get_index_selection(model_index)
+        values = self.data[model][self.plot_type].transpose(TIME, LAT).isel(
+            {TIME: time_idx, LAT: lat_slice}).values
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            band_mean = np.where(valid, values, 0.).sum(axis=1) / count
+
+        return (model_index.time.values[time_idx],
+                np.where(count > 0, band_mean, np.nan))
+
+    @staticmethod
+    def __to_ensemble_pd(models, band_means) -> pd.DataFrame:
+        """Write band means of every model into one array, on the time
+        axis shared by all models, i.e. the same rows as joining
+        per-model DataFrames in get_raw_ensemble_pd()
+
+        :param models: Models, in the order of band_means
+        :param band_means: (time steps, band mean values) of every model
+        :return: ensemble of models as pd.DataFrame
+        :rtype: pd.DataFrame
+        """
+        time_axis = np.unique(np.concatenate([ time for time, __ in band_means ]))
+
+        band_mean = np.full((len(models), len(time_axis)), np.nan)
+        for i, (time, values) in enumerate(band_means):
+            band_mean[i, np.searchsorted(time_axis, time)] = values
+        # same as in to_pd_dataframe(): zeros are treated as missing values
+        band_mean[band_mean == 0] = np.nan
+
+        data = pd.DataFrame(band_mean.T,
+                            index=pd.DatetimeIndex(time_axis, name=TIME),
+                            columns=models)
+        return data
+
+    def get_raw_ensemble_batch(self, models) -> pd.DataFrame:
+        """Build the ensemble of tco3_zm models in one array, without
+        joining per-model DataFrames: band means of every model are
+        written into the array on the time axis shared by all models.
+        Time index keeps the time steps of the models.
+
+        :param models: Models to process for tco3_zm
+        :return: ensemble of models as pd.DataFrame
+        :rtype: pd.DataFrame
+        """
+        band_means = map_tasks(self.__get_band_mean, models)
+        return self.__to_ensemble_pd(models, band_means)
+
+    def get_raw_ensemble_cube(self, models) -> pd.DataFrame:
+        """Build the ensemble of tco3_zm models from the ensemble cube,
+        i.e. all models are selected and averaged at once.
+        Months of the cube are mapped back to the time steps of the models
+        (by their ModelIndex), i.e. time index is the same as of
+        get_raw_ensemble_pd() without the cube.
+
+        :param models: Models to process for tco3_zm
+        :return: ensemble of models as pd.DataFrame
+        :rtype: pd.DataFrame
+        """
+        cube = self._cube
+        month_idx = cube.get_month_indices(self.begin, self.end,
+                                           self.__get_months())
+        model_idx = [ cube.model_index[m] for m in models ]
+        month_idx = month_idx[cube.mask[model_idx][:, month_idx].any(axis=0)]
+
+        band_mean = cube.get_band_mean(models, month_idx,
+                                       self.lat_min, self.lat_max)
+        band_means = []
+        months = cube.time.values[month_idx].astype('datetime64[M]')
+        for i, m in enumerate(models):
+            valid = cube.mask[model_idx[i]][month_idx]
+            model_index = self._model_indexes[m]
+            # more than one time step per month: the cube keeps the last one
+            time_idx = np.searchsorted(model_index.months, months[valid],
+                                       side='right') - 1
+            band_means.append((model_index.time.values[time_idx],
+                               band_mean[i, valid]))
+
+        return self.__to_ensemble_pd(models, band_means)
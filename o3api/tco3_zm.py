@@ -16,12 +16,18 @@ Module with two classes:
 to produce tco3_zm and tco3_return plots correspondingly
 """
 
+import copy
 import logging
 import numpy as np
 import o3api.config as cfg
 #import o3api.debug as dbg
+import os
 from o3api.prepare import PrepareData
 import pandas as pd
+import threading
+import time
+
+from collections import OrderedDict
 from scipy import signal
 
 
@@ -39,6 +45,272 @@ TCO3Return = cfg.netCDF_conf['tco3_r']
 api_c = cfg.api_conf
 
 
+class _LRUCache:
+    """Cache of results shared by all requests, keys start with the data
+    version. Least recently used entries are dropped, entries of other
+    data versions are dropped when data is reloaded.
+
+    :param size_option: Name of the config option with the cache size
+                        (None: no limit)
+    """
+
+    def __init__(self, size_option):
+        self.size_option = size_option
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_size(self):
+        """Return the maximum number of entries (0: no cache)
+        """
+        if self.size_option is None:
+            return float('inf')
+
+        return getattr(cfg, self.size_option)
+
+    def get(self, key):
+        """Return the cached value, None if there is no entry
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Store the value, drop stale and least recently used entries
+        """
+        if self.get_size() <= 0:
+            return
+
+        with self._lock:
+            for old_key in [k for k in self._entries if k[0] != key[0]]:
+                del self._entries[old_key]
+            self._entries[key] = value
+            while len(self._entries) > self.get_size():
+                self._entries.popitem(last=False)
+
+    def keys(self):
+        """Return the keys of all entries
+        """
+        with self._lock:
+            return list(self._entries.keys())
+
+    def reset_lock(self):
+        """Re-create the lock in a forked process, it may be held by a thread
+        """
+        self._lock = threading.Lock()
+
+
+# reference values and yearly reference series: (ref_value, ref_data)
+_ref_cache = _LRUCache('O3AS_REF_CACHE_SIZE')
+# smoothed and shifted series of single models
+_series_cache = _LRUCache('O3AS_SERIES_CACHE_SIZE')
+# reference values and series computed at load time, kept until data reload
+_kept_results = _LRUCache(None)
+
+
+def _get_cached(key, cache=_series_cache):
+    """Return the result kept since data loading or from the cache,
+    None if there is no entry
+    """
+    value = _kept_results.get(key)
+    if value is None:
+        value = cache.get(key)
+
+    return value
+
+
+def _reset_cache_locks():
+    _ref_cache.reset_lock()
+    _series_cache.reset_lock()
+    _kept_results.reset_lock()
+
+
+os.register_at_fork(after_in_child=_reset_cache_locks)
+
+
+def interpolate_forward(values):
+    """Interpolate NaNs linearly along the first axis, column by column,
+    same as pandas interpolate(method='linear', limit_direction='forward'):
+    NaNs before the first valid value are kept,
+    NaNs after the last valid value are set to the last valid value
+
+    :param values: 2-D array, time x columns
+    :return: interpolated array (copy of values)
+    :rtype: numpy.ndarray
+    """
+    values = np.array(values, dtype=np.float64)
+    x = np.arange(values.shape[0])
+    for j in range(values.shape[1]):
+        valid = ~np.isnan(values[:, j])
+        if valid.all() or not valid.any():
+            continue
+        invalid = ~valid & (x > np.argmax(valid))
+        values[invalid, j] = np.interp(x[invalid], x[valid], values[valid, j])
+
+    return values
+
+
+def get_yearly_mean(data) -> pd.DataFrame:
+    """Average data for every year, skipping NaNs, i.e. the same as
+    data.groupby([data.index.year]).mean(): rows are put in a
+    years x (steps per year, e.g. 12) x columns array and summed up
+    along the steps for all years and columns at once, with the same
+    compensated summation as in pandas
+
+    :param data: pd.DataFrame with time as index
+    :return: yearly averaged data, with years as index
+    :rtype: pd.DataFrame
+    """
+    if not all(dtype == np.float64 for dtype in data.dtypes) or len(data) == 0:
+        return data.groupby([data.index.year], dropna=True).mean()
+
+    year_values, labels = np.unique(np.asarray(data.index.year),
+                                    return_inverse=True)
+    # position of every row within its year, rows keep their order
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    steps = np.arange(len(labels)) - np.searchsorted(labels, labels)
+    values = np.full((len(year_values), steps.max() + 1, data.shape[1]), np.nan)
+    values[labels, steps] = data.to_numpy()[order]
+
+    sumx = np.zeros((len(year_values), data.shape[1]))
+    compensation = np.zeros_like(sumx)
+    nobs = np.zeros(sumx.shape, dtype=np.int64)
+    for step in range(values.shape[1]):
+        val = values[:, step]
+        valid = ~np.isnan(val)
+        y = val - compensation
+        t = sumx + y
+        compensation = np.where(valid, t - sumx - y, compensation)
+        sumx = np.where(valid, t, sumx)
+        nobs += valid
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(nobs > 0, sumx / nobs, np.nan)
+
+    return pd.DataFrame(mean,
+                        index=pd.Index(year_values, name=data.index.name),
+                        columns=data.columns)
+
+
+def smooth_boxcar(values, bwindow):
+    """Apply boxcar smoothing to all columns at once, the same as
+    ProcessForTCO3Zm.__smooth_boxcar() column by column: only the range
+    between the first and the last valid value of every column is smoothed,
+    NaNs within the range are interpolated, the range is mirrored at both
+    ends, the moving average is calculated from cumulative sums.
+    Columns with less than bwindow values in the range are not smoothed.
+
+    :param values: 2-D array, years x models
+    :param bwindow: Boxcar window
+    :return: smoothed array, mask of columns not smoothed
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_rows = values.shape[0]
+    valid = ~np.isnan(values)
+    first = np.argmax(valid, axis=0)
+    last = n_rows - 1 - np.argmax(valid[::-1], axis=0)
+    smoothed = valid.any(axis=0) & (last - first + 1 >= bwindow)
+    values_out = values.copy()
+    if not smoothed.any():
+        return values_out, valid.any(axis=0)
+
+    first = first[smoothed]
+    last = last[smoothed]
+    data = interpolate_forward(values[:, smoothed])
+    # extend by bwindow-1 rows at both ends, mirror every column
+    # at its first and last valid value (without repeating them)
+    pad = bwindow - 1
+    rows_ext = np.arange(-pad, n_rows + pad)[:, np.newaxis]
+    idx = np.where(rows_ext < first, 2*first - rows_ext,
+                   np.where(rows_ext > last, 2*last - rows_ext, rows_ext))
+    data_ext = np.take_along_axis(data, np.clip(idx, 0, n_rows - 1), axis=0)
+    data_ext[(idx < first) | (idx > last)] = 0.
+    data_cumsum = np.zeros((data_ext.shape[0] + 1, data_ext.shape[1]))
+    np.cumsum(data_ext, axis=0, out=data_cumsum[1:])
+
+    # window of the row i is [i - (pad - pad//2), i + pad//2],
+    # as in scipy.signal.convolve(..., mode='same')
+    rows = np.arange(n_rows)
+    boxcar_values = (data_cumsum[rows + pad//2 + pad + 1] -
+                     data_cumsum[rows + pad//2]) / bwindow
+    in_range = (rows[:, np.newaxis] >= first) & (rows[:, np.newaxis] <= last)
+    values_out[:, smoothed] = np.where(in_range, boxcar_values,
+                                       values[:, smoothed])
+
+    return values_out, valid.any(axis=0) & ~smoothed
+
+
+def find_return_years(values, years, ref_values, ref_year):
+    """Find return years for all regions and models at once: the first
+    year after ref_year + O3AS_TCO3Return_REF_YEAR_MARGIN with the value
+    above the reference value of the region
+
+    :param values: 3-D array, regions x years x models
+    :param years: years of the values
+    :param ref_values: reference value of every region
+    :param ref_year: reference year
+    :return: return years, regions x models (NaN if there is no return)
+    :rtype: np.ndarray
+    """
+    values = np.asarray(values, dtype=np.float64)
+    years = np.asarray(years)
+    ref_values = np.asarray(ref_values, dtype=np.float64)
+    year_min = ref_year + cfg.O3AS_TCO3Return_REF_YEAR_MARGIN
+    # NaN values are never above the reference value
+    returned = ((years > year_min)[np.newaxis, :, np.newaxis] &
+                (values > ref_values[:, np.newaxis, np.newaxis]))
+    idx = np.argmax(returned, axis=1)
+
+    return np.where(returned.any(axis=1), years[idx], np.nan)
+
+
+def calc_stats(values, percentiles=(), columns=None):
+    """Calculate NaN-aware mean, std, median and percentiles over models
+    for every year, with one sort of the values
+
+    :param values: 2-D array, years x models
+    :param percentiles: Percentiles to calculate (0..100), e.g. [10, 90]
+    :param columns: Mask of models to include (default: all)
+    :return: {'mean', 'std', 'median', 'p<percentile>': array per year}
+    :rtype: dict
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    if columns is not None:
+        valid &= np.asarray(columns, dtype=bool)[np.newaxis, :]
+    count = valid.sum(axis=1)
+    values_valid = np.where(valid, values, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, values, 0.).sum(axis=1) / count
+        deviation = np.where(valid, values - mean[:, np.newaxis], 0.)
+        # sample standard deviation (ddof=1), as in pandas
+        std = np.sqrt((deviation**2).sum(axis=1) / (count - 1))
+    std[count < 2] = np.nan
+
+    # NaNs are sorted to the end, i.e. valid values are first count values
+    values_sorted = np.sort(values_valid, axis=1)
+    rows = np.arange(len(values_sorted))
+    def __percentile(q):
+        # linear interpolation between closest ranks, as in numpy
+        position = np.maximum(count - 1, 0) * q / 100.
+        lo = np.floor(position).astype(int)
+        hi = np.ceil(position).astype(int)
+        value_lo = values_sorted[rows, lo]
+        value_hi = values_sorted[rows, hi]
+        return np.where(count > 0,
+                        value_lo + (value_hi - value_lo) * (position - lo),
+                        np.nan)
+
+    stats = {'mean': mean, 'std': std, 'median': __percentile(50)}
+    for q in percentiles:
+        stats[F"p{q:g}"] = __percentile(q)
+
+    return stats
+
+
 class ProcessForTCO3Zm(PrepareData):
     """Subclass of :class:`PrepareData` to calculate tco3_zm
     """
@@ -47,6 +319,8 @@ class ProcessForTCO3Zm(PrepareData):
         self.ref_meas = kwargs[api_c['ref_meas']]
         self.ref_year = kwargs[api_c['ref_year']]
         self.ref_fillna = kwargs[api_c['ref_fillna']]
+        # percentiles over models to add to the plot (optional)
+        self.percentiles = kwargs.get('percentiles', [])
         self.ref_value, self.ref_data = self.get_ref_value()
 
     def __smooth_boxcar(self, data, bwindow):
@@ -60,8 +334,11 @@ class ProcessForTCO3Zm(PrepareData):
         # 2. if there are NaN _within_ the data range, interpolate
         # 3. apply boxcar smoothing on this data slice
         # 4. update original data with smoothed values
-        first_idx = data.first_valid_index()
-        last_idx = data.last_valid_index()
+        # valid values are only searched within the model coverage
+        years = self.get_coverage_years(data.name)
+        data_valid = data if years is None else data.loc[years[0]:years[1]]
+        first_idx = data_valid.first_valid_index()
+        last_idx = data_valid.last_valid_index()
         data_smooth = data.loc[first_idx:last_idx]
         data_smooth = data_smooth.interpolate()
         logger.debug("signal(for smoothing) (len={}): {}".format(len(data_smooth),data_smooth))
@@ -102,20 +379,52 @@ class ProcessForTCO3Zm(PrepareData):
 
         # try to interpolate values in the ref_meas
         if self.ref_meas in models and self.ref_fillna:
-            data[self.ref_meas] = data[self.ref_meas].interpolate(method='linear',
-                                                                  limit_direction='forward',
-                                                                  axis=0)
-        data = data.groupby([data.index.year], dropna=True).mean()
+            data[self.ref_meas] = interpolate_forward(
+                data[[self.ref_meas]].to_numpy())[:, 0]
+        data = get_yearly_mean(data)
 
         # select data according to the years requested
         #return data[(data.index>=self.begin) & (data.index<=self.end)]
 
         return data
 
+    def __get_cache_key(self, *args):
+        """Return the key of a result in the caches: data version and
+        request parameters (+ args), None if the data has no version
+        """
+        version = getattr(self.data, 'version', None)
+        if version is None:
+            return None
+
+        return (version, self.plot_type, self.ref_meas, self.ref_year,
+                bool(self.ref_fillna), self.begin, self.end,
+                self.lat_min, self.lat_max, tuple(self.month)) + args
+
     def get_ref_value(self):
-        """Get reference value for the reference year
+        """Get reference value for the reference year.
+        The result is cached per data version and request parameters.
+        
+        :return: reference value (tco3_zm at reference year), ref_meas data
+        """
+        key = self.__get_cache_key()
+        cached = None
+        if key is not None:
+            cached = _get_cached(key, _ref_cache)
+        if cached is not None:
+            ref_value, ref_data = cached
+            return ref_value, ref_data.copy()
+
+        ref_value, ref_data = self.__calc_ref_value()
+
+        if key is not None:
+            _ref_cache.put(key, (ref_value, ref_data.copy()))
+
+        return ref_value, ref_data
+
+    def __calc_ref_value(self):
+        """Calculate reference value for the reference year
         
-        :return: reference value (tco3_zm at reference year)
+        :return: reference value (tco3_zm at reference year), ref_meas data
         """
 
         # get ref_meas averaged over a year
@@ -134,17 +443,113 @@ class ProcessForTCO3Zm(PrepareData):
         :rtype: pd.DataFrame
         """        
         data = self.get_ensemble_yearly(models)
-        # NB: __smooth_boxcar smooths data only with valid values, 
+        # smooth every model on the same year axis, whatever other models
+        # are processed in the batch: interpolation within the data range
+        # and the boxcar window then depend only on the model itself
+        data = data.reindex(pd.Index(range(self.begin, self.end + 1),
+                                     name=data.index.name))
+        # NB: smooth_boxcar smooths data only with valid values, 
         # i.e. we avoid NaNs at beginning and end of dataframe
         # see __smooth_boxcar() for details
-        data = data.apply(self.__smooth_boxcar, 
-                          args = [smooth_win], 
-                          axis = 0,
-                          result_type = 'broadcast'
-                         )
+        values, not_smoothed = smooth_boxcar(data.to_numpy(), smooth_win)
+        data_smooth = pd.DataFrame(values, index=data.index,
+                                   columns=data.columns)
+        # too short data ranges are processed column by column
+        for model in data.columns[not_smoothed]:
+            data_smooth[model] = self.__smooth_boxcar(data[model].copy(),
+                                                      smooth_win)
         
+        return data_smooth
+
+    def get_time_window(self, model, smooth_win):
+        """Return the years to process for the model, i.e. the years which
+        affect the result. For tco3_zm all requested years are plotted.
+
+        :param model: The model to process
+        :param smooth_win: Boxcar window
+        :return: (first year, last year)
+        """
+        return self.begin, self.end
+
+    def __get_window_smoothed(self, models, smooth_win, begin, end):
+        """Smooth data of the models, processing only years begin..end.
+        Models with no value at the first year, but with values before it,
+        are processed for all requested years: the start of smoothing,
+        and interpolation of missing values depend on earlier years then.
+
+        :return: smoothed data points, at least for years begin..end
+        :rtype: pd.DataFrame
+        """
+        if (begin, end) == (self.begin, self.end):
+            return self.get_ensemble_smoothed(models, smooth_win)
+
+        planned = copy.copy(self)
+        planned.begin, planned.end = begin, end
+        data = planned.get_ensemble_smoothed(models, smooth_win)
+        years = { m: self.get_coverage_years(m) for m in models }
+        models_all = [ m for m in models
+                       if (begin not in data.index or
+                           np.isnan(data.loc[begin, m])) and
+                          (years[m] is None or years[m][0] < begin) ]
+        if len(models_all) > 0:
+            logger.debug(F"{models_all}: no value at {begin}, all years")
+            data_all = self.get_ensemble_smoothed(models_all, smooth_win)
+            data = pd.concat([data.drop(columns=models_all), data_all],
+                             axis=1, join='outer')[models]
+
         return data
 
+    def get_ensemble_smoothed_shifted(self, models, smooth_win,
+                                      keep=False) -> pd.DataFrame:
+        """Smooth tco3_zm data using boxcar, then shift it to reference year.
+        Series of every model are cached, i.e. only models not
+        processed before for the same parameters are processed.
+        
+        :param models: Models to process
+        :param smooth_win: Boxcar window
+        :param keep: If True, keep series until data is reloaded
+        :return: smoothed and shifted data points
+        :rtype: pd.DataFrame
+        """
+        windows = { m: self.get_time_window(m, smooth_win) for m in models }
+        keys = { m: self.__get_cache_key(m, smooth_win, windows[m])
+                 for m in models }
+        series = { m: _get_cached(keys[m]) for m in models
+                   if keys[m] is not None }
+        series = { m: s for m, s in series.items() if s is not None }
+        models_new = [ m for m in models if m not in series ]
+        logger.debug(F"cached series: {list(series.keys())}, new: {models_new}")
+
+        # models are processed in batches with the same years to process,
+        # ref_meas is processed alone, its interpolation (ref_fillna)
+        # must not depend on other models
+        batches = {}
+        for m in models_new:
+            batches.setdefault((m == self.ref_meas, windows[m]), []).append(m)
+        for (__, (begin, end)), batch in batches.items():
+            data = self.__get_window_smoothed(batch, smooth_win, begin, end)
+            data = self.get_ensemble_shifted(data)
+            for m in batch:
+                series[m] = data[m].copy()
+                if keys[m] is not None:
+                    _series_cache.put(keys[m], series[m])
+
+        if keep and all(keys[m] is not None for m in models):
+            for m in models:
+                _kept_results.put(keys[m], series[m])
+            _kept_results.put(self.__get_cache_key(),
+                              (self.ref_value, self.ref_data.copy()))
+
+        data = pd.concat([ series[m] for m in models ],
+                         axis=1, join='outer', copy=True)
+        # series are smoothed on the fixed year axis (get_ensemble_smoothed),
+        # years without values of any model are not returned
+        data_valid = data.dropna(how='all')
+        if len(data_valid) > 0:
+            data = data_valid
+
+        return data.reindex(columns=models).sort_index()
+
     def get_ensemble_shifted(self, data) -> pd.DataFrame:
         """Shift tco3_zm data to reference year
         
@@ -174,30 +579,29 @@ class ProcessForTCO3Zm(PrepareData):
 
         return data_shifted
         
-    def get_ensemble_stats(self, data) -> pd.DataFrame:
-        """Calculate Mean, Std, Median for tco3_zm data
+    def get_ensemble_stats(self, data, percentiles=()) -> pd.DataFrame:
+        """Calculate Mean, Std, Median (and percentiles) for tco3_zm data
         
         :param data: data to process as pd.DataFrame
-        :return: updated pd.DateFrame with stats columns 
+        :param percentiles: Percentiles to add as 'MMP<percentile>' columns
+        :return: new pd.DateFrame with data and stats columns
+                 (data is not changed)
         :rtype: pd.DataFrame
         """
-        # make data copy, as adding a new "Mean" column
-        # affects "Median" calculation, issue#52
-        data_in = data.copy(deep=True)
-        
-        # exclude also ref_measurement from the calculation of statistics
-        models = data_in.columns.to_list()
-        if self.ref_meas in models:
-            data_in.drop(self.ref_meas, axis=1, inplace=True)
-        
-        # calculate stats
-        data['MMMean'] = data_in.mean(axis=1, skipna=True)
-        data_std = data_in.std(axis=1, skipna=True)
-        data['MMMean-Std'] = data['MMMean'] - data_std
-        data['MMMean+Std'] = data['MMMean'] + data_std
-        data['MMMedian'] = data_in.median(axis=1, skipna=True) 
-        
-        return data
+        # exclude also ref_measurement from the calculation of statistics.
+        # stats are calculated from data columns only, issue#52
+        stats = calc_stats(data.to_numpy(), percentiles,
+                           columns=(data.columns != self.ref_meas))
+
+        data_stats = pd.DataFrame({
+            'MMMean': stats['mean'],
+            'MMMean-Std': stats['mean'] - stats['std'],
+            'MMMean+Std': stats['mean'] + stats['std'],
+            'MMMedian': stats['median'],
+            **{ F"MMP{q:g}": stats[F"p{q:g}"] for q in percentiles }
+            }, index=data.index)
+
+        return pd.concat([data, data_stats], axis=1)
 
     #@dbg._profile
     def get_ensemble_for_plot(self, models) -> pd.DataFrame:
@@ -208,9 +612,8 @@ class ProcessForTCO3Zm(PrepareData):
         :rtype: pd.DataFrame
         """  
         boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
-        data = self.get_ensemble_smoothed(models, boxcar_win)
-        data_shift = self.get_ensemble_shifted(data)
-        data_plot = self.get_ensemble_stats(data_shift)
+        data_shift = self.get_ensemble_smoothed_shifted(models, boxcar_win)
+        data_plot = self.get_ensemble_stats(data_shift, self.percentiles)
 
         if self.ref_meas in models:
             data_plot[self.ref_meas] = self.ref_data
@@ -229,6 +632,34 @@ class ProcessForTCO3ZmReturn(ProcessForTCO3Zm):
         kwargs[api_c['plot_t']] = TCO3
         super().__init__(data, **kwargs)
         self.region = kwargs['region']
+
+    def get_time_window(self, model, smooth_win):
+        """Return the years to process for the model: return years depend
+        only on the value at the reference year (shift) and values after it
+        (search for the return), smoothed with the boxcar window.
+        The reference measurement with ref_fillna is processed for all years,
+        as its missing values are interpolated from earlier months,
+        as well as models with less valid years than the boxcar window
+        in the planned years (they cannot be smoothed then).
+
+        :param model: The model to process
+        :param smooth_win: Boxcar window
+        :return: (first year, last year)
+        """
+        if model == self.ref_meas and self.ref_fillna:
+            return self.begin, self.end
+
+        # boxcar window of the reference year starts that many years before
+        pad = smooth_win - 1
+        begin = max(self.begin, self.ref_year - (pad - pad//2))
+        if begin > self.end:
+            return self.begin, self.end
+
+        years = self.get_coverage_years(model)
+        if years is not None and years[1] - max(years[0], begin) + 1 < smooth_win:
+            return self.begin, self.end
+
+        return begin, self.end
       
     def get_return_years(self, data):
         """Calculate return year for every model
@@ -237,30 +668,20 @@ class ProcessForTCO3ZmReturn(ProcessForTCO3Zm):
         :return: return years for models
         :rtype: pd.DataFrame
         """
-        refMargin = cfg.O3AS_TCO3Return_REF_YEAR_MARGIN
-        logger.debug(F"{self.ref_year}: {self.ref_value} (ref_value)")
-        def __get_return_year(data):
-            # 1. search for years with tco3_zm > ref_value
-            # 2. remove duplicates
-            # 3. only two rows will be left (False, True)
-            data_return = (data[data.index>(self.ref_year+refMargin)]>self.ref_value).drop_duplicates()
-            try:
-                idx = data_return.values.tolist().index(True)
-                return_year = data_return.index[idx]
-            except:
-                return_year = np.nan              
-
-            return return_year
-
-        return_years = {} # model: year
-        models = data.columns
-        [ return_years.update({m: __get_return_year(data[m])}) for m in models ]
-        logger.debug(F"return_years: {return_years}")
-
-        data_return_years = pd.DataFrame(return_years, index=[self.region])
-        #data_return_years['mean_year'] = data_return_years.mean(axis=1, skipna=True)
-       
-        return data_return_years
+        return get_regions_return_years([self], [data])
+
+    def get_ensemble_return(self, models):
+        """Build the ensemble of smoothed and shifted tco3_zm series,
+        including the ensemble stats, to search for return years
+
+        :param models: Models to process for tco3_zm
+        :return: ensemble of models and stats, as pd.DataFrame
+        :rtype: pd.DataFrame
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        data_shift = super().get_ensemble_smoothed_shifted(models, boxcar_win)
+
+        return super().get_ensemble_stats(data_shift)
 
     def get_ensemble_for_plot(self, models):
         """Build the ensemble of tco3_return points for plotting
@@ -270,10 +691,73 @@ class ProcessForTCO3ZmReturn(ProcessForTCO3Zm):
         :rtype: pd.DataFrame
         """  
 
-        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
-        data = super().get_ensemble_smoothed(models, boxcar_win)
-        data_shift = super().get_ensemble_shifted(data)
-        data_tco3 = super().get_ensemble_stats(data_shift)
+        data_tco3 = self.get_ensemble_return(models)
         data_return_years = self.get_return_years(data_tco3)
 
-        return data_return_years
\ No newline at end of file
+        return data_return_years
+
+
+def get_regions_return_years(pdata_regions, data_regions):
+    """Calculate return years of several regions at once: ensembles of
+    all regions are stacked and searched by one find_return_years() call
+
+    :param pdata_regions: ProcessForTCO3ZmReturn of every region
+    :param data_regions: ensemble of every region (same columns),
+                         see ProcessForTCO3ZmReturn.get_ensemble_return()
+    :return: return years, regions x models
+    :rtype: pd.DataFrame
+    """
+    columns = data_regions[0].columns
+    years = data_regions[0].index
+    for data in data_regions[1:]:
+        years = years.union(data.index)
+    values = np.stack([ data.reindex(index=years, columns=columns).to_numpy()
+                        for data in data_regions ])
+    for pdata in pdata_regions:
+        logger.debug(F"{pdata.region}, {pdata.ref_year}: " +
+                     F"{pdata.ref_value} (ref_value)")
+    # all regions are requested with the same reference year
+    return_years = find_return_years(values, years.to_numpy(),
+                                     [ p.ref_value for p in pdata_regions ],
+                                     pdata_regions[0].ref_year)
+    data_return_years = pd.DataFrame(return_years,
+                                     index=[ p.region for p in pdata_regions ],
+                                     columns=columns)
+    # years are integers, NaN only if there is no return
+    data_return_years = data_return_years.astype(
+        {m: years.dtype for m in columns
+         if data_return_years[m].notna().all()})
+    logger.debug(F"return_years: {data_return_years}")
+
+    return data_return_years
+
+
+def precompute_default_regions(data):
+    """Compute tco3_return series of all models for the default regions
+    and the default reference, keep them until data is reloaded:
+    tco3_return requests with defaults only calculate the ensemble stats
+
+    :param data: tco3_zm data as {'model': xarray dataset}
+    """
+    time_start = time.time()
+    models = list(data.keys())
+    kwargs = dict({api_c['plot_t']: TCO3Return,
+                   api_c['models']: models,
+                   api_c['begin']: cfg.O3AS_TCO3Return_BEGIN_YEAR,
+                   api_c['end']: cfg.O3AS_TCO3Return_END_YEAR,
+                   api_c['month']: []},
+                  **cfg.O3AS_TCO3Return_DEFAULT_REF)
+    if kwargs[api_c['ref_meas']] not in models:
+        logger.warning(F"[PRECOMPUTE] {kwargs[api_c['ref_meas']]} " +
+                       "is not in data, skipped")
+        return
+
+    boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+    for region, region_params in cfg.tco3_return_regions.items():
+        pdata = ProcessForTCO3ZmReturn(data, **dict(kwargs, region=region,
+                                                    **region_params))
+        pdata.get_ensemble_smoothed_shifted(models, boxcar_win, keep=True)
+
+    logger.info(F"[PRECOMPUTE] tco3_return: {len(models)} models, " +
+                F"{len(cfg.tco3_return_regions)} regions " +
+                F"({time.time() - time_start:.2f}s)")
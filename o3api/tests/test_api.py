@@ -15,7 +15,7 @@ import os
 import unittest
 from o3api import api as o3api
 from o3api import config as cfg
-from o3api import load as o3load
+from o3api import datastore as o3store
 import connexion
 import json
 
@@ -59,10 +59,8 @@ class TestAPIMethods(unittest.TestCase):
         cls.client = app.app.test_client()
 
         # dictionary to load O3as data in memory (in o3api!)
-        o3api.o3data = {
-            'tco3_zm': o3load.LoadData(cfg.O3AS_DATA_BASEPATH,
-                                       "tco3_zm").load_dataset_ensemble()
-        }
+        o3api.o3data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [TCO3])
+        o3api.o3data.start()
 
         cls.headers = {'Content-Type': 'application/json',
                        'Accept': 'application/json'}
@@ -104,6 +102,54 @@ class TestAPIMethods(unittest.TestCase):
         self.assertEqual(200, meta.status_code)
         #self.assertTrue(type(meta.data) is dict)
 
+    def test_api_health(self):
+        health = self.client.get('/api/v1/health', headers=self.headers)
+        self.assertEqual(200, health.status_code)
+        health_info = json.loads(health.data)
+        self.assertEqual('ok', health_info['status'])
+        self.assertEqual(0, health_info['tasks_queued'])
+        self.assertGreaterEqual(health_info['workers'], 1)
+
+    def test_api_ready(self):
+        ready = self.client.get('/api/v1/ready', headers=self.headers)
+        logger.debug(F"[API] ready = {ready.data}")
+        self.assertEqual(200, ready.status_code)
+        self.assertTrue(json.loads(ready.data)['ready'])
+
+    def test_api_data_not_ready(self):
+        o3data = o3api.o3data
+        o3api.o3data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [TCO3])
+        try:
+            request = "/api/v1/data/tco3_zm?" + self.data_tco3_request_q
+            result = self.client.post(request, headers=self.headers,
+                                      data=json.dumps(self.tco3_body))
+            self.assertEqual(503, result.status_code)
+            self.assertIn('Retry-After', result.headers)
+        finally:
+            o3api.o3data = o3data
+
+    def test_api_memory(self):
+        admin_token = cfg.O3AS_ADMIN_TOKEN
+        cfg.O3AS_ADMIN_TOKEN = 'test-token'
+        try:
+            headers = dict(self.headers, **{'X-Admin-Token': 'test-token'})
+            memory = self.client.get('/api/v1/memory', headers=headers)
+        finally:
+            cfg.O3AS_ADMIN_TOKEN = admin_token
+        logger.debug(F"[API] memory = {memory.data}")
+        self.assertEqual(200, memory.status_code)
+        self.assertEqual(os.getpid(), json.loads(memory.data)['pid'])
+
+    def test_api_memory_not_authorized(self):
+        headers = dict(self.headers, **{'X-Admin-Token': 'wrong-token'})
+        memory = self.client.get('/api/v1/memory', headers=headers)
+        self.assertEqual(403, memory.status_code)
+
+    def test_api_reload_not_authorized(self):
+        headers = dict(self.headers, **{'X-Admin-Token': 'wrong-token'})
+        reload_info = self.client.post('/api/v1/admin/reload', headers=headers)
+        self.assertEqual(403, reload_info.status_code)
+
     def test_api_data(self):
         ptypes = self.client.get('/api/v1/data')
         self.assertEqual(200, ptypes.status_code)
@@ -173,6 +219,18 @@ class TestAPIMethods(unittest.TestCase):
         logger.debug(F"[API] plot_tco3.content_type: {plot.content_type}")
         self.assertEqual(200, plot.status_code)
 
+    def test_api_plots_tco3_zm_percentiles(self):
+        plot = self.client.post('/api/v1/plots/tco3_zm',
+                                headers=self.headers,
+                                data=json.dumps(self.tco3_body),
+                                query_string=(self.plots_tco3_request_q +
+                                              '&percentiles=10,90')
+                               )
+        self.assertEqual(200, plot.status_code)
+        curves = [ c['model'] for c in json.loads(plot.data) ]
+        self.assertIn('MMP10', curves)
+        self.assertIn('MMP90', curves)
+
     def test_api_plots_tco3_return(self):
         logger.info(F"[API] plot_return: {self.plots_tco3_request_q}")
         # WHY json=json.dumps(request_j) does NOT work?!
@@ -13,11 +13,16 @@ import numpy as np
 import os
 import pandas as pd
 import pytest
+import shutil
+import tempfile
+import threading
 import xarray as xr
 import unittest
 
 from o3api import config as cfg
 from o3api import api as o3api
+from o3api import datastore as o3store
+from o3api import ensemble as o3ensemble
 from o3api import load as o3load
 from o3api import prepare as o3prepare
 from o3api import tco3_zm as tco3zm
@@ -49,6 +54,8 @@ REF_FILLNA = 'ref_fillna'
 
 data_base_path = 'tmp/data'
 cfg.O3AS_DATA_BASEPATH = data_base_path
+# the ensemble cube is opt-in, build it to compare with the datasets
+cfg.O3AS_ENSEMBLE_CUBE = True
 
 @pytest.mark.run(order=1)
 class TestPackageMethods(unittest.TestCase):
@@ -185,10 +192,8 @@ class TestPackageMethods(unittest.TestCase):
         logger.info(F"kwargs: {cls.kwargs}")
 
         # dictionary to load O3as data in memory (in o3api!)
-        o3api.o3data = {
-                ptype: o3load.LoadData(cfg.O3AS_DATA_BASEPATH,
-                                       "tco3_zm").load_dataset_ensemble()
-        }
+        o3api.o3data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [ptype])
+        o3api.o3data.start()
 
         # initialize how to process data
         cls.rdata = o3prepare.PrepareData(o3api.o3data[ptype], **cls.kwargs)
@@ -268,6 +273,21 @@ class TestPackageMethods(unittest.TestCase):
         self.assertTrue(type(o3models_info) is list)
         self.assertTrue(type(o3models_info[0]) is dict)
 
+    def test_get_models_info_cached(self):
+        """
+        Test that the catalogue of models is reused until data is reloaded
+        """
+        o3models_info = o3api.get_models_info()
+        catalogue = o3api._models_catalogue
+        o3models_info[0][TCO3]['isdata'] = None
+        self.assertEqual(o3api.get_models_info()[0][TCO3]['isdata'], True)
+        self.assertIs(o3api._models_catalogue, catalogue)
+        self.assertIn(self.kwargs[MODELS][0],
+                      o3api.get_models_list(**{PTYPE: TCO3}))
+        o3api.o3data.generation += 1
+        self.assertEqual(o3api.get_models_info(), catalogue['models'])
+        self.assertIsNot(o3api._models_catalogue, catalogue)
+
     def test_get_model_detail_type(self):
         """
         Test that model detail is dict
@@ -289,6 +309,25 @@ class TestPackageMethods(unittest.TestCase):
         logger.info(o3model_detail)
         self.assertNotIn(self.fake_email, str(o3model_detail))
 
+    def test_get_model_detail_not_loaded(self):
+        """
+        Test that model detail is read from the datafile,
+        if the plot type is not loaded
+        """
+        model = self.kwargs[MODELS][0]
+        o3model_detail = o3api.get_model_detail(model=model)
+        o3data = o3api.o3data
+        try:
+            o3api.o3data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [TCO3],
+                                             preload=[])
+            o3api.o3data.start()
+            o3model_lazy = o3api.get_model_detail(model=model)
+            self.assertFalse(o3api.o3data.is_loaded(TCO3))
+        finally:
+            o3api.o3data = o3data
+        self.assertEqual(o3model_lazy[TCO3]['original_metadata'],
+                         o3model_detail[TCO3]['original_metadata'])
+
     def test_get_dataset_values(self):
         """
         Test that returned dataset values are the same as generated.
@@ -297,6 +336,184 @@ class TestPackageMethods(unittest.TestCase):
         ds = o3api.o3data['tco3_zm'][model]
         self.assertEqual(ds, self.o3ds)
 
+    def test_load_dataset_ensemble_parallel(self):
+        """
+        Test that datasets loaded in parallel are the same as loaded one by one
+        """
+        ds_serial = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3,
+                                    workers=1).load_dataset_ensemble()
+        for executor in ['thread', 'process']:
+            loader = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3,
+                                     workers=2, executor=executor)
+            ds_parallel = loader.load_dataset_ensemble()
+            self.assertEqual(list(ds_serial.keys()), list(ds_parallel.keys()))
+            self.assertEqual(list(ds_serial.keys()),
+                             list(loader.load_timings.keys()))
+            for model in ds_serial.keys():
+                xr.testing.assert_identical(ds_serial[model], ds_parallel[model])
+
+    def test_load_dataset_compact(self):
+        """
+        Test that the compact mode keeps float32 values and original metadata,
+        bytes of datasets and cube are counted
+        """
+        ds_plain = o3api.o3data[TCO3]
+        ds_compact = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3, workers=1,
+                                     compact=True).load_dataset_ensemble()
+        model = self.kwargs[MODELS][0]
+        self.assertEqual(ds_compact[model][TCO3].dtype, np.float32)
+        self.assertEqual(ds_compact[model].attrs, {})
+        self.assertEqual(ds_compact.metadata[model],
+                         ds_plain[model].to_dict(data=False))
+        self.assertLess(ds_compact.nbytes[model], ds_plain.nbytes[model])
+        np.testing.assert_allclose(ds_compact[model][TCO3].values,
+                                   ds_plain[model][TCO3].values, rtol=1e-6)
+        self.assertIsNone(ds_compact.cube.data)
+        for ds_ensemble in [ds_plain, ds_compact]:
+            self.assertEqual(ds_ensemble.nbytes[model],
+                             ds_ensemble[model].nbytes +
+                             ds_ensemble.cube.get_nbytes(model))
+
+    def test_load_dataset_lat_normalized(self):
+        """
+        Test that latitudes are sorted in ascending order (original ones kept)
+        and interpolated to the common grid, if configured
+        """
+        with tempfile.TemporaryDirectory() as lat_path:
+            model = 'test-o3api-north-south'
+            os.makedirs(os.path.join(lat_path, model), exist_ok=True)
+            ds_orig = self.o3ds.isel({LAT: slice(None, None, -1)})
+            ds_orig.to_netcdf(os.path.join(lat_path, model, TCO3 + '-test.nc'))
+
+            ds_ensemble = o3load.LoadData(lat_path, TCO3,
+                                          workers=1).load_dataset_ensemble()
+            lat = ds_ensemble[model].coords[LAT].values
+            self.assertTrue(np.all(np.diff(lat) > 0))
+            np.testing.assert_array_equal(ds_ensemble.lat_original[model],
+                                          ds_orig.coords[LAT].values)
+            np.testing.assert_allclose(ds_ensemble[model][TCO3].values,
+                                       self.o3ds[TCO3].values)
+
+            ds_ensemble = o3load.LoadData(lat_path, TCO3, workers=1,
+                                          lat_grid='-80,80,20').load_dataset_ensemble()
+            np.testing.assert_array_equal(ds_ensemble[model].coords[LAT].values,
+                                          np.arange(-80, 81, 20))
+            np.testing.assert_allclose(ds_ensemble[model][TCO3].values,
+                                       self.o3ds[TCO3].sel({LAT: slice(-80, 80, 2)}).values)
+
+    def test_load_dataset_cache(self):
+        """
+        Test that cached datasets are the same and stale entries are rebuilt
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = self.kwargs[MODELS][0]
+            ds_plain = o3api.o3data[TCO3][model]
+            loader = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3,
+                                     workers=1, cache_dir=cache_dir)
+            # first pass fills the cache, second one reads from it
+            for i in range(2):
+                ds_cached = loader.load_dataset_ensemble()[model]
+                xr.testing.assert_identical(ds_plain, ds_cached)
+
+            model_path = os.path.join(data_base_path, model,
+                                      os.listdir(os.path.join(data_base_path,
+                                                              model))[0])
+            self.assertIsNotNone(loader._cache.get(model_path))
+            os.utime(model_path)
+            self.assertIsNone(loader._cache.get(model_path))
+
+    def test_datastore_reload(self):
+        """
+        Test that reload loads only new datafiles and swaps data at once
+        """
+        with tempfile.TemporaryDirectory() as reload_path:
+            model, model_new = self.kwargs[MODELS][0], self.kwargs[MODELS][1]
+            shutil.copytree(os.path.join(data_base_path, model),
+                            os.path.join(reload_path, model))
+            store = o3store.DataStore(reload_path, [TCO3])
+            store.start()
+            ds_ensemble = store[TCO3]
+
+            # no changes => same data
+            self.assertEqual(store.reload()['generation'], 0)
+            self.assertIs(store[TCO3], ds_ensemble)
+
+            shutil.copytree(os.path.join(data_base_path, model_new),
+                            os.path.join(reload_path, model_new))
+            reload_info = store.reload()
+            self.assertEqual(reload_info['generation'], 1)
+            self.assertEqual(reload_info['changes'][TCO3]['added'], [model_new])
+            # unchanged dataset is re-used, previous ensemble is not modified
+            self.assertIs(store[TCO3][model], ds_ensemble[model])
+            self.assertEqual(list(ds_ensemble.keys()), [model])
+            self.assertCountEqual(store[TCO3].cube.models, [model, model_new])
+
+    def test_datastore_start_background(self):
+        """
+        Test that data is loaded in the background and progress is reported
+        """
+        store = o3store.DataStore(data_base_path, [TCO3])
+        self.assertFalse(store.is_ready())
+        with self.assertLogs('__name__', level='INFO') as logs:
+            store.start(background=True)
+            self.assertTrue(store.wait_ready(timeout=60))
+            store._loading.join(timeout=60)
+        # logged when ready
+        self.assertTrue(any("data is loaded" in l and "'ready': True" in l
+                            for l in logs.output))
+        status = store.get_status()
+        self.assertTrue(status['ready'])
+        self.assertEqual(status['plot_types'], [TCO3])
+        self.assertEqual(status['models_loaded'], len(store[TCO3]))
+        self.assertEqual(status['models_total'], status['models_loaded'])
+        self.assertGreater(status['bytes_loaded'], 0)
+        self.assertIsNone(status['error'])
+
+    def test_datastore_fork_during_start(self):
+        """
+        Test that a process forked during background loading (e.g. a loader
+        worker) does not load again, only restart() does it
+        """
+        prepared = threading.Event()
+        release = threading.Event()
+
+        def _prepare(ptype, ds_ensemble):
+            prepared.set()
+            release.wait(60)
+
+        store = o3store.DataStore(data_base_path, [TCO3], prepare=_prepare)
+        store.start(background=True)
+        self.assertTrue(prepared.wait(60))
+        pid = os.fork()
+        if pid == 0:
+            loading = [ t for t in threading.enumerate() if t.name == 'o3start' ]
+            ready = store.is_ready()
+            store.restart()
+            os._exit(0 if (len(loading) == 0 and not ready and
+                           store.wait_ready(timeout=60)) else 1)
+        release.set()
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertTrue(store.wait_ready(timeout=60))
+
+    def test_datastore_lazy_load(self):
+        """
+        Test that plot types not preloaded are loaded when first requested
+        """
+        store = o3store.DataStore(data_base_path, [TCO3, VMRO3], preload=[])
+        self.assertEqual(len(store), 0)
+        self.assertIn(TCO3, store)
+        self.assertFalse(store.is_loaded(TCO3))
+        ds_ensemble = store[TCO3]
+        self.assertTrue(store.is_loaded(TCO3))
+        self.assertFalse(store.is_loaded(VMRO3))
+        self.assertIs(store[TCO3], ds_ensemble)
+        self.assertEqual(list(store.keys()), [TCO3])
+        with self.assertRaises(KeyError):
+            store['unknown_zm']
+        with self.assertRaises(ValueError):
+            o3store.DataStore(data_base_path, [TCO3], preload=['unknown_zm'])
+
     def test_get_dataslice_type(self):
         """
         Test that the returned dataset type is correct, xarray.Dataset
@@ -336,6 +553,229 @@ class TestPackageMethods(unittest.TestCase):
         ds = self.rdata.get_raw_ensemble_pd(models)
         self.assertTrue(type(ds) is pd.DataFrame)
 
+    def test_get_ensemble_cube(self):
+        """
+        Test that the ensemble built from the cube is the same
+        as built from the datasets model by model
+        """
+        self.assertIsNotNone(o3api.o3data[TCO3].cube)
+        models = [self.ref_meas] + self.kwargs[MODELS]
+        kwargs = dict(self.kwargs, **{MONTH: [1, 2, 12]})
+        data_cube = o3prepare.PrepareData(o3api.o3data[TCO3],
+                                          **kwargs).get_raw_ensemble_pd(models)
+        data_pd = o3prepare.PrepareData(dict(o3api.o3data[TCO3]),
+                                        **kwargs).get_raw_ensemble_pd(models)
+        pd.testing.assert_frame_equal(data_cube, data_pd, check_freq=False)
+
+    def test_get_dataslice_index(self):
+        """
+        Test that selection by the model index is the same as by labels
+        """
+        ds_ensemble = o3api.o3data[TCO3]
+        model = self.kwargs[MODELS][0]
+        self.assertIsNotNone(ds_ensemble.model_indexes[model])
+        for begin, end, month in [(1970, 2100, ''), (1980, 1990, [1, 2, 12]),
+                                  (1960, 1975, [6]), (2095, 2110, '')]:
+            kwargs = dict(self.kwargs, **{BEGIN: begin, END: end, MONTH: month})
+            ds_index = o3prepare.PrepareData(ds_ensemble,
+                                             **kwargs).get_dataslice(model)
+            ds_label = o3prepare.PrepareData(dict(ds_ensemble),
+                                             **kwargs).get_dataslice(model)
+            xr.testing.assert_identical(ds_index, ds_label)
+
+    def test_coverage(self):
+        """
+        Test that the coverage is built at load time and
+        models without data for the request are skipped (NaN)
+        """
+        ds_ensemble = o3api.o3data[TCO3]
+        model = self.kwargs[MODELS][0]
+        coverage = ds_ensemble.coverage[model]
+        self.assertEqual(coverage['time_min'].year, 1970)
+        self.assertEqual(coverage['time_max'].year, 2100)
+        self.assertEqual((coverage['lat_min'], coverage['lat_max']), (-90., 90.))
+
+        kwargs = dict(self.kwargs, **{BEGIN: 2000, END: 2050})
+        data = o3prepare.PrepareData(ds_ensemble, **kwargs)
+        self.assertTrue(data.is_covered(model))
+        self.assertEqual(data.get_coverage_years(model), (2000, 2050))
+        data._coverage = dict(ds_ensemble.coverage,
+                              **{model: dict(coverage, lat_max=-30.)})
+        self.assertFalse(data.is_covered(model))
+        data_raw = data.get_raw_ensemble_pd(self.kwargs[MODELS])
+        self.assertEqual(data_raw.columns.to_list(), self.kwargs[MODELS])
+        self.assertTrue(data_raw[model].isna().all())
+        self.assertFalse(data_raw[self.kwargs[MODELS][1]].isna().all())
+
+    def test_get_band_mean(self):
+        """
+        Test that band means from cumulative sums are the same
+        as averaged over the selected latitudes
+        """
+        cube = o3api.o3data[TCO3].cube
+        models = self.kwargs[MODELS]
+        month_idx = cube.get_month_indices(1980, 1990)
+        model_idx = [ cube.model_index[m] for m in models ]
+        for lat_min, lat_max in [(-10, 10), (-90, 90), (5, 25), (3, 7)]:
+            band_mean = cube.get_band_mean(models, month_idx, lat_min, lat_max)
+            lat_slice = cube.get_lat_slice(lat_min, lat_max)
+            values = cube.data[model_idx][:, month_idx, lat_slice]
+            if values.shape[2] > 0:
+                np.testing.assert_allclose(band_mean, values.mean(axis=2))
+            else:
+                self.assertTrue(np.isnan(band_mean).all())
+
+    def test_get_ensemble_batch(self):
+        """
+        Test that the ensemble assembled in one array is the same
+        as joined from the datasets model by model
+        """
+        ds_batch = o3ensemble.DatasetEnsemble(o3api.o3data[TCO3])
+        ds_batch.model_indexes = o3api.o3data[TCO3].model_indexes
+        models = [self.ref_meas] + self.kwargs[MODELS]
+        for month in ['', [1, 2, 12]]:
+            kwargs = dict(self.kwargs, **{MONTH: month})
+            data_batch = o3prepare.PrepareData(ds_batch,
+                                               **kwargs).get_raw_ensemble_pd(models)
+            data_pd = o3prepare.PrepareData(dict(ds_batch),
+                                            **kwargs).get_raw_ensemble_pd(models)
+            pd.testing.assert_frame_equal(data_batch, data_pd, check_freq=False)
+
+    def test_get_ensemble_time_stamps(self):
+        """
+        Test that the ensemble from the cube and assembled in one array
+        keeps the time steps of the models, e.g. mid-month
+        """
+        models = [self.ref_meas] + self.kwargs[MODELS]
+        ds_models = {}
+        for i, m in enumerate(models):
+            ds = o3api.o3data[TCO3][m].copy(deep=True)
+            ds[TIME] = ds.indexes[TIME] + pd.Timedelta(days=14, hours=12*i)
+            ds_models[m] = ds
+        ds_cube = o3ensemble.DatasetEnsemble(ds_models)
+        ds_cube.model_indexes = { m: o3ensemble.ModelIndex.from_dataset(ds)
+                                  for m, ds in ds_models.items() }
+        ds_batch = o3ensemble.DatasetEnsemble(ds_cube)
+        ds_batch.model_indexes = ds_cube.model_indexes
+        ds_cube.cube = o3ensemble.EnsembleCube.from_datasets(ds_models, TCO3)
+        data_pd = o3prepare.PrepareData(ds_models,
+                                        **self.kwargs).get_raw_ensemble_pd(models)
+        self.assertEqual(len(data_pd), len(models)*len(ds_models[models[0]][TIME]))
+        for data in [ds_cube, ds_batch]:
+            data_ensemble = o3prepare.PrepareData(data,
+                                                  **self.kwargs).get_raw_ensemble_pd(models)
+            pd.testing.assert_frame_equal(data_ensemble, data_pd, check_freq=False)
+
+    def test_get_ensemble_threads(self):
+        """
+        Test that models processed in the thread pool give the same ensemble
+        """
+        ds_batch = o3ensemble.DatasetEnsemble(o3api.o3data[TCO3])
+        ds_batch.model_indexes = o3api.o3data[TCO3].model_indexes
+        models = [self.ref_meas] + self.kwargs[MODELS]
+        process_workers = cfg.O3AS_PROCESS_WORKERS
+        try:
+            for data in [ds_batch, dict(ds_batch)]:
+                cfg.O3AS_PROCESS_WORKERS = 1
+                data_serial = o3prepare.PrepareData(
+                    data, **self.kwargs).get_raw_ensemble_pd(models)
+                cfg.O3AS_PROCESS_WORKERS = 2
+                data_threads = o3prepare.PrepareData(
+                    data, **self.kwargs).get_raw_ensemble_pd(models)
+                pd.testing.assert_frame_equal(data_serial, data_threads)
+            # tasks of the pool run nested tasks without waiting for the pool
+            nested = o3prepare.map_tasks(
+                lambda x: o3prepare.map_tasks(lambda y: x*y, [1, 2]), [1, 2, 3])
+            self.assertEqual(nested, [[1, 2], [2, 4], [3, 6]])
+            self.assertEqual(o3prepare.get_executor_status()['tasks_queued'], 0)
+        finally:
+            cfg.O3AS_PROCESS_WORKERS = process_workers
+
+    def test_get_ensemble_cube_mmap(self):
+        """
+        Test that the memory-mapped cube gives the same ensemble
+        """
+        with tempfile.TemporaryDirectory() as mmap_dir:
+            models = self.kwargs[MODELS]
+            data_ref = self.rdata.get_raw_ensemble_pd(models)
+            # first pass stores the cube, second one maps stored files
+            for i in range(2):
+                ds_mmap = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3,
+                                          mmap_dir=mmap_dir).load_dataset_ensemble()
+                self.assertTrue(isinstance(ds_mmap.cube.data, np.memmap))
+                # dataset values are not loaded, i.e. not counted
+                self.assertLess(ds_mmap.nbytes[models[0]],
+                                ds_mmap[models[0]].nbytes +
+                                ds_mmap.cube.get_nbytes(models[0]))
+                data_mmap = o3prepare.PrepareData(ds_mmap,
+                                                  **self.kwargs).get_raw_ensemble_pd(models)
+                pd.testing.assert_frame_equal(data_ref, data_mmap)
+            self.assertEqual(len([ d for d in os.listdir(mmap_dir)
+                                   if d.startswith(TCO3 + '-') ]), 1)
+
+    def test_get_ensemble_cube_mmap_implied(self):
+        """
+        Test that the mmap mode builds the cube also if it is not configured,
+        datasets are loaded in memory if the cube cannot be built
+        """
+        cube_option = cfg.O3AS_ENSEMBLE_CUBE
+        try:
+            cfg.O3AS_ENSEMBLE_CUBE = False
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                mmap_dir = os.path.join(tmp_dir, 'mmap')
+                ds_mmap = o3load.LoadData(cfg.O3AS_DATA_BASEPATH, TCO3,
+                                          mmap_dir=mmap_dir).load_dataset_ensemble()
+                self.assertTrue(isinstance(ds_mmap.cube.data, np.memmap))
+
+                # vmro3_zm-like data: (time, plev, lat), no cube
+                data_path = os.path.join(tmp_dir, 'data')
+                model = self.kwargs[MODELS][0]
+                os.makedirs(os.path.join(data_path, model))
+                ds_plev = self.o3ds.rename({TCO3: VMRO3}).expand_dims(plev=[10., 50.])
+                ds_plev.to_netcdf(os.path.join(data_path, model, VMRO3 + '-test.nc'))
+                ds_vmro3 = o3load.LoadData(data_path, VMRO3,
+                                           mmap_dir=mmap_dir,
+                                           compact=True).load_dataset_ensemble()
+                self.assertIsNone(ds_vmro3.cube)
+                self.assertEqual(ds_vmro3[model][VMRO3].dtype, np.float32)
+                self.assertEqual(ds_vmro3.nbytes[model], ds_vmro3[model].nbytes)
+        finally:
+            cfg.O3AS_ENSEMBLE_CUBE = cube_option
+
+    def test_get_yearly_mean(self):
+        """
+        Test that yearly means and interpolation are exactly the same as in pandas
+        """
+        data = self.rdata.get_raw_ensemble_pd(self.kwargs[MODELS])
+        # sparse data with more than one time step per month
+        data.index = data.index + pd.to_timedelta(
+            np.arange(len(data)) % 3 * 10, unit='D')
+        data = data.mask(np.random.random(data.shape) < 0.3)
+        pd.testing.assert_frame_equal(tco3zm.get_yearly_mean(data),
+                                      data.groupby([data.index.year]).mean(),
+                                      check_exact=True)
+        model = self.kwargs[MODELS][0]
+        np.testing.assert_array_equal(
+            tco3zm.interpolate_forward(data[[model]].to_numpy())[:, 0],
+            data[model].interpolate(method='linear', limit_direction='forward',
+                                    axis=0).values)
+
+    def test_smooth_boxcar(self):
+        """
+        Test that smoothing of all models is the same as model by model
+        """
+        data = self.pdata.get_ensemble_yearly(self.kwargs[MODELS])
+        # models with NaNs at the beginning, at the end and within the range
+        data.iloc[:3, 0] = np.nan
+        data.iloc[-2:, 1] = np.nan
+        data.iloc[5, 1] = np.nan
+        for bwindow in [3, 4]:
+            values, not_smoothed = tco3zm.smooth_boxcar(data.to_numpy(), bwindow)
+            data_ref = data.apply(self.pdata._ProcessForTCO3Zm__smooth_boxcar,
+                                  args=[bwindow], axis=0, result_type='broadcast')
+            self.assertFalse(not_smoothed.any())
+            np.testing.assert_allclose(values, data_ref.to_numpy(), rtol=1e-12)
+
     def test_get_ref_value(self):
         """
         Test that get_ref_value() is correct
@@ -344,6 +784,241 @@ class TestPackageMethods(unittest.TestCase):
         logger.info(F"ref_value: {ref_value}")
         self.assertTrue(ref_value == 0.5)
 
+    def test_get_ensemble_stats(self):
+        """
+        Test that ensemble stats are the same as in pandas, without reference
+        """
+        data = self.pdata.get_ensemble_yearly([self.ref_meas] +
+                                              self.kwargs[MODELS])
+        data.iloc[:5, 1] = np.nan
+        data_models = data[self.kwargs[MODELS]].copy()
+        columns = list(data.columns)
+        data_stats = self.pdata.get_ensemble_stats(data, percentiles=[10, 90])
+        # input is not changed
+        self.assertEqual(list(data.columns), columns)
+        np.testing.assert_allclose(data_stats['MMMean'],
+                                   data_models.mean(axis=1), rtol=1e-12)
+        np.testing.assert_allclose(data_stats['MMMean+Std'],
+                                   data_models.mean(axis=1) +
+                                   data_models.std(axis=1), rtol=1e-12)
+        np.testing.assert_allclose(data_stats['MMMedian'],
+                                   data_models.median(axis=1), rtol=1e-12)
+        np.testing.assert_allclose(data_stats['MMP90'],
+                                   data_models.quantile(0.9, axis=1), rtol=1e-12)
+
+    def test_find_return_years(self):
+        """
+        Test return years of several regions against the search per model
+        """
+        years = np.arange(1960, 2101)
+        values = np.random.random((3, len(years), 5))
+        values[values < 0.1] = np.nan
+        ref_values = np.array([0.5, 0.99, 2.])
+        ref_year = 1980
+        year_min = ref_year + cfg.O3AS_TCO3Return_REF_YEAR_MARGIN
+        return_years = tco3zm.find_return_years(values, years, ref_values,
+                                                ref_year)
+        self.assertEqual(return_years.shape, (3, 5))
+        for r in range(3):
+            for m in range(5):
+                data = pd.Series(values[r, :, m], index=years)
+                returned = data[(data.index > year_min) & (data > ref_values[r])]
+                if len(returned) > 0:
+                    self.assertEqual(return_years[r, m], returned.index[0])
+                else:
+                    self.assertTrue(np.isnan(return_years[r, m]))
+
+    def test_get_ref_value_cached(self):
+        """
+        Test that the reference value is reused and not shared between requests
+        """
+        ptype = TCO3
+        key_cached = (o3api.o3data[ptype].version, ptype, self.ref_meas,
+                      self.ref_year)
+        pdata = tco3zm.ProcessForTCO3Zm(o3api.o3data[ptype], **self.kwargs)
+        keys = tco3zm._ref_cache.keys()
+        self.assertTrue(any(k[:4] == key_cached for k in keys))
+        self.assertEqual(pdata.ref_value, self.pdata.ref_value)
+        pd.testing.assert_frame_equal(pdata.ref_data, self.pdata.ref_data)
+        self.assertIsNot(pdata.ref_data, self.pdata.ref_data)
+        # other latitude band => other entry
+        kwargs = dict(self.kwargs, **{LAT_MIN: 0})
+        tco3zm.ProcessForTCO3Zm(o3api.o3data[ptype], **kwargs)
+        keys_new = tco3zm._ref_cache.keys()
+        self.assertEqual(len(set(keys_new) - set(keys)), 1)
+
+    def test_get_return_time_window(self):
+        """
+        Test that return years are the same as processing all years,
+        also for a model without value at the first planned year
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        models = self.kwargs[MODELS]
+        data = o3ensemble.DatasetEnsemble({ m: o3api.o3data[TCO3][m].copy(deep=True)
+                                            for m in [self.ref_meas] + models })
+        pdata = tco3zm.ProcessForTCO3ZmReturn(data, **dict(self.kwargs,
+                                                           region='test'))
+        begin, end = pdata.get_time_window(models[0], boxcar_win)
+        self.assertEqual((begin, end), (self.ref_year - 5, self.kwargs[END]))
+        data[models[1]][TCO3].loc[{TIME: str(begin)}] = np.nan
+
+        data_return = pdata.get_ensemble_for_plot(models)
+        data_all = pdata.get_ensemble_stats(pdata.get_ensemble_shifted(
+            pdata.get_ensemble_smoothed(models, boxcar_win)))
+        data_all = data_all.loc[data_all.index >= self.ref_year]
+        data_shift = pdata.get_ensemble_smoothed_shifted(models, boxcar_win)
+        pd.testing.assert_frame_equal(
+            data_shift.loc[data_shift.index >= self.ref_year],
+            data_all[models])
+        pd.testing.assert_frame_equal(data_return,
+                                      pdata.get_return_years(data_all))
+
+    def test_get_return_time_window_short(self):
+        """
+        Test that a model with less years than the boxcar window after
+        the planned first year is processed for all years
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        models = self.kwargs[MODELS]
+        short_model = models[0]
+        data = o3ensemble.DatasetEnsemble({ m: o3api.o3data[TCO3][m].copy(deep=True)
+                                            for m in [self.ref_meas] + models })
+        data.coverage = dict(o3api.o3data[TCO3].coverage)
+        ds = data[short_model]
+        data[short_model] = ds.sel({TIME: ds[TIME].dt.year <= self.ref_year + 2})
+        data.coverage[short_model] = dict(
+            data.coverage[short_model],
+            time_max=data[short_model].indexes[TIME].max())
+        pdata = tco3zm.ProcessForTCO3ZmReturn(data, **dict(self.kwargs,
+                                                           region='test'))
+        self.assertEqual(pdata.get_time_window(short_model, boxcar_win),
+                         (self.kwargs[BEGIN], self.kwargs[END]))
+
+        data_return = pdata.get_ensemble_for_plot(models)
+        data_all = pdata.get_ensemble_stats(pdata.get_ensemble_shifted(
+            pdata.get_ensemble_smoothed(models, boxcar_win)))
+        pd.testing.assert_frame_equal(data_return,
+                                      pdata.get_return_years(data_all))
+
+    def test_get_regions_return_years(self):
+        """
+        Test that return years of stacked regions are the same
+        as found region by region
+        """
+        models = self.kwargs[MODELS]
+        pdata_regions = [ tco3zm.ProcessForTCO3ZmReturn(
+                            o3api.o3data[TCO3],
+                            **dict(self.kwargs, region=r, **p))
+                          for r, p in cfg.tco3_return_regions.items() ]
+        data_regions = [ p.get_ensemble_return(models) for p in pdata_regions ]
+        data_return = tco3zm.get_regions_return_years(pdata_regions,
+                                                      data_regions)
+        data_ref = pd.concat([ p.get_ensemble_for_plot(models)
+                               for p in pdata_regions ])
+        self.assertEqual(list(data_return.index),
+                         list(cfg.tco3_return_regions.keys()))
+        pd.testing.assert_frame_equal(data_return, data_ref, check_dtype=False)
+
+    def test_precompute_default_regions(self):
+        """
+        Test that results for default regions are precomputed at load time
+        and are the same as computed per request
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        default_ref = cfg.O3AS_TCO3Return_DEFAULT_REF
+        cache_sizes = cfg.O3AS_REF_CACHE_SIZE, cfg.O3AS_SERIES_CACHE_SIZE
+        prepared = []
+        try:
+            # results are kept also without LRU caches
+            cfg.O3AS_REF_CACHE_SIZE, cfg.O3AS_SERIES_CACHE_SIZE = 0, 0
+            cfg.O3AS_TCO3Return_DEFAULT_REF = {REF_MEAS: self.ref_meas,
+                                               REF_YEAR: self.ref_year,
+                                               REF_FILLNA: False}
+            data = o3store.DataStore(cfg.O3AS_DATA_BASEPATH, [TCO3],
+                prepare=lambda ptype, ds: (prepared.append(ptype),
+                                           tco3zm.precompute_default_regions(ds)))
+            data.start()
+            models = list(data[TCO3].keys())
+            self.assertEqual(prepared, [TCO3])
+            keys = [ k for k in tco3zm._kept_results.keys()
+                     if k[0] == data[TCO3].version ]
+            n_regions = len(cfg.tco3_return_regions)
+            self.assertEqual(len(keys), n_regions*(len(models) + 1))
+
+            region, region_params = list(cfg.tco3_return_regions.items())[2]
+            kwargs = dict(self.kwargs, **cfg.O3AS_TCO3Return_DEFAULT_REF,
+                          **region_params, region=region,
+                          begin=cfg.O3AS_TCO3Return_BEGIN_YEAR,
+                          end=cfg.O3AS_TCO3Return_END_YEAR, month=[])
+            pdata = tco3zm.ProcessForTCO3ZmReturn(data[TCO3], **kwargs)
+            data_kept = pdata.get_ensemble_smoothed_shifted(
+                self.kwargs[MODELS], boxcar_win)
+            data_all = pdata.get_ensemble_shifted(
+                pdata.get_ensemble_smoothed(self.kwargs[MODELS], boxcar_win))
+            pd.testing.assert_frame_equal(
+                data_kept.loc[data_kept.index >= self.ref_year],
+                data_all.loc[data_all.index >= self.ref_year])
+        finally:
+            cfg.O3AS_TCO3Return_DEFAULT_REF = default_ref
+            cfg.O3AS_REF_CACHE_SIZE, cfg.O3AS_SERIES_CACHE_SIZE = cache_sizes
+
+    def test_get_ensemble_smoothed_shifted(self):
+        """
+        Test that series from the cache give the same ensemble as processing
+        all models, also if models are added or removed
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        models = [self.ref_meas] + self.kwargs[MODELS]
+        kwargs = dict(self.kwargs, **{LAT_MIN: -30})
+        pdata = tco3zm.ProcessForTCO3Zm(o3api.o3data[TCO3], **kwargs)
+        data_ref = pd.concat(
+            [pdata.get_ensemble_shifted(
+                pdata.get_ensemble_smoothed([m], boxcar_win)) for m in models],
+            axis=1)
+        for models_request in [models[:2], models[::-1], models]:
+            data = pdata.get_ensemble_smoothed_shifted(models_request,
+                                                       boxcar_win)
+            pd.testing.assert_frame_equal(data, data_ref[models_request])
+        pd.testing.assert_frame_equal(
+            pdata.get_ensemble_smoothed_shifted(self.kwargs[MODELS], boxcar_win),
+            pdata.get_ensemble_shifted(
+                pdata.get_ensemble_smoothed(self.kwargs[MODELS], boxcar_win)))
+
+    def test_get_ensemble_smoothed_shifted_gap(self):
+        """
+        Test that the series of a model with missing years does not depend
+        on other models requested together with it
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        models = self.kwargs[MODELS]
+        gap_model = models[0]
+        series = []
+        for models_request in [[gap_model], models]:
+            # new ensemble (version), i.e. series are not taken from the cache
+            data = o3ensemble.DatasetEnsemble(
+                { m: o3api.o3data[TCO3][m].copy(deep=True)
+                  for m in [self.ref_meas] + models })
+            ds = data[gap_model]
+            data[gap_model] = ds.sel({TIME: ~ds[TIME].dt.year.isin([1990, 1991])})
+            pdata = tco3zm.ProcessForTCO3Zm(data, **self.kwargs)
+            data_shift = pdata.get_ensemble_smoothed_shifted(models_request,
+                                                             boxcar_win)
+            series.append(data_shift[gap_model])
+        pd.testing.assert_series_equal(series[0], series[1])
+
+    def test_get_ensemble_smoothed_shifted_no_empty_years(self):
+        """
+        Test that years without data in any model are not returned
+        """
+        boxcar_win = cfg.O3AS_TCO3Return_BOXCAR_WINDOW
+        models = self.kwargs[MODELS]
+        # data start in 1970
+        kwargs = dict(self.kwargs, **{BEGIN: 1950})
+        pdata = tco3zm.ProcessForTCO3Zm(o3api.o3data[TCO3], **kwargs)
+        data_shift = pdata.get_ensemble_smoothed_shifted(models, boxcar_win)
+        self.assertFalse(data_shift.isna().all(axis=1).any())
+        self.assertGreaterEqual(data_shift.index.min(), 1970)
+
     def test_get_date_range(self):
         """
         Test correctness of returned min/max dates
@@ -16,9 +16,14 @@ if [[ -z "${O3API_WORKERS}" ]]; then
     export O3API_WORKERS=1
 fi
 
+# gunicorn configuration, e.g. O3API_PRELOAD=True to load data only once
+# in the master process and share it with all workers
+O3API_GUNICORN_CONF="$(dirname "$(readlink -f "$0")")/gunicorn.conf.py"
+
 if [ "${ENABLE_HTTPS}" == "True" ]; then
   if test -e /certs/cert.pem && test -f /certs/key.pem ; then
-    exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" \
+    exec gunicorn -c "$O3API_GUNICORN_CONF" \
+    --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" \
     --certfile /certs/cert.pem --keyfile /certs/key.pem \
     --limit-request-line 8190 --timeout "$O3API_TIMEOUT"  o3api:app
   else
@@ -26,6 +31,7 @@ if [ "${ENABLE_HTTPS}" == "True" ]; then
     exit 1
   fi
 else
-  exec gunicorn --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" \
+  exec gunicorn -c "$O3API_GUNICORN_CONF" \
+  --bind $O3API_LISTEN_IP:$O3API_PORT -w "$O3API_WORKERS" \
   --limit-request-line 8190 --timeout "$O3API_TIMEOUT"  o3api:app
 fi